@@ -0,0 +1,761 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+import time
+
+import aiosqlite
+from aiogram import Bot, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiohttp import web
+
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+# Бенчмарки никогда не трогают рабочую dating.db
+os.environ.setdefault("DB_NAME", os.path.join(tempfile.mkdtemp(prefix="bench-"), "dating.db"))
+
+import main
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {}
+    pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))]
+    return {
+        "count": len(samples),
+        "mean_us": round(sum(samples) / len(samples) * 1e6, 1),
+        "p50_us": round(pick(0.50) * 1e6, 1),
+        "p95_us": round(pick(0.95) * 1e6, 1),
+        "p99_us": round(pick(0.99) * 1e6, 1),
+    }
+
+
+async def fill_users(db: main.Database, users: int):
+    rng = random.Random(1)
+    async with db.transaction() as conn:
+        await conn.executemany(
+            "INSERT OR REPLACE INTO users (user_id, gender, pref_gender, age, pref_age_min, pref_age_max) VALUES (?, ?, ?, ?, ?, ?)",
+            [(uid, rng.choice("mf"), rng.choice(["m", "f", "all"]), rng.randint(16, 60), 16, 60) for uid in range(1, users + 1)],
+        )
+
+
+# === DB: соединение на каждый вызов против общего пула ===
+async def bench_db(args):
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    main.database = main.Database(path)
+    await main.database.open()
+    await main.init_db()
+    await fill_users(main.database, args.users)
+
+    ids = [random.randint(1, args.users) for _ in range(args.ops)]
+
+    before = []
+    for uid in ids:
+        t = time.perf_counter()
+        async with aiosqlite.connect(path) as conn:
+            async with conn.execute("SELECT * FROM users WHERE user_id = ?", (uid,)) as cursor:
+                await cursor.fetchone()
+        before.append(time.perf_counter() - t)
+
+    after = []
+    for uid in ids:
+        t = time.perf_counter()
+        # Сам пул, без кэша анкет перед ним — иначе меряли бы попадания в кэш
+        await main.database.fetchone("SELECT * FROM users WHERE user_id = ?", (uid,))
+        after.append(time.perf_counter() - t)
+
+    await main.database.close()
+    return {"connect_per_call": percentiles(before), "pool": percentiles(after)}
+
+
+# === Поиск: задержка от размера базы и честность выборки ===
+def build_index(users: int, boosted: int = 0, seed: int = 1):
+    rng = random.Random(seed)
+    index = main.MatchIndex()
+    for uid in range(1, users + 1):
+        index.add(uid, rng.choice("mf"), rng.choice(["m", "f", "all"]), rng.randint(16, 60), 16, 60,
+                  uid <= boosted)
+    return index
+
+
+async def bench_match(args):
+    latency = {}
+    for users in (args.users // 100, args.users // 10, args.users):
+        index = build_index(users)
+        samples = []
+        for uid in random.choices(range(1, users + 1), k=args.ops):
+            t = time.perf_counter()
+            index.pick(uid)
+            samples.append(time.perf_counter() - t)
+        latency[users] = percentiles(samples)
+    violations = []
+
+    # Искатели заблокировали большую часть своего среза: выдача не должна уходить
+    # в проход по всей таблице и не должна отдавать заблокированных
+    blocked_latency = {}
+    index = build_index(args.users, boosted=args.users // 100)
+    seekers = random.sample(range(1, args.users + 1), 20)
+    for share in (0.5, 0.9):
+        for uid in seekers:
+            index.blocks.pop(uid, None)
+            index.fresh_blocks.pop(uid, None)
+            for bucket, lo, hi in index._ranges(uid):
+                for _, cand_id in bucket[lo:hi]:
+                    if random.random() < share:
+                        index.block(uid, cand_id)
+        samples = []
+        for uid in random.choices(seekers, k=args.ops):
+            t = time.perf_counter()
+            match = index.pick(uid)
+            samples.append(time.perf_counter() - t)
+            if match and not index.is_compatible(uid, match[0]):
+                violations.append(f"blocked {share}: выдана неподходящая анкета {match[0]} для {uid}")
+        blocked_latency[share] = percentiles(samples)
+
+    # Все кандидаты подходят искателю: доля бустов должна совпасть с теорией,
+    # а обычные анкеты — выпадать равномерно (хи-квадрат на степень свободы ~ 1).
+    pool, boosted = 200, 20
+    index = main.MatchIndex()
+    index.add(0, "m", "f", 30, 16, 60)
+    for uid in range(1, pool + 1):
+        index.add(uid, "f", "all", 30, 16, 60, uid <= boosted)
+    draws = args.ops * 50
+    hits = [0] * (pool + 1)
+    for _ in range(draws):
+        hits[index.pick(0)[0]] += 1
+    w = main.BOOST_WEIGHT
+    expected_share = boosted * w / (boosted * w + pool - boosted)
+    share = sum(hits[1:boosted + 1]) / draws
+    plain = hits[boosted + 1:]
+    mean = sum(plain) / len(plain)
+    chi2 = sum((h - mean) ** 2 / mean for h in plain) / (len(plain) - 1)
+    # Пять стандартных отклонений: ложная тревога практически исключена
+    share_tolerance = 5 * (expected_share * (1 - expected_share) / draws) ** 0.5
+    if abs(share - expected_share) > share_tolerance:
+        violations.append(f"доля бустов {share:.4f} вместо {expected_share:.4f} ± {share_tolerance:.4f}")
+    chi2_tolerance = 5 * (2 / (len(plain) - 1)) ** 0.5
+    if abs(chi2 - 1) > chi2_tolerance:
+        violations.append(f"хи-квадрат на степень свободы {chi2:.3f}, допустимо 1 ± {chi2_tolerance:.3f}")
+    return {
+        "pick_latency": latency,
+        "pick_latency_blocked": blocked_latency,
+        "boost_weight": w,
+        "boosted_share": round(share, 4),
+        "boosted_share_expected": round(expected_share, 4),
+        "plain_chi2_per_dof": round(chi2, 3),
+        "violations": violations,
+    }
+
+
+# === Запись свайпов: коммит на строку против группового коммита ===
+async def bench_writes(args):
+    path = os.path.join(tempfile.mkdtemp(), "writes.db")
+    main.database = main.Database(path)
+    await main.database.open()
+    await main.init_db()
+    swipers = 200
+    per_swiper = max(1, args.ops // swipers)
+    sql = "INSERT OR IGNORE INTO blocks (blocker_id, blocked_id) VALUES (?, ?)"
+
+    async def run(mode, base):
+        async def swiper(uid):
+            for i in range(per_swiper):
+                params = (base + uid, base + i)
+                if mode == "commit_per_row":
+                    await main.database.execute(sql, params)
+                else:
+                    await main.database.write_behind(sql, params, wait=mode == "group_commit_durable")
+        t = time.perf_counter()
+        await asyncio.gather(*(swiper(uid) for uid in range(swipers)))
+        await main.database.flush_writes()
+        elapsed = time.perf_counter() - t
+        return {"rows": swipers * per_swiper, "elapsed_s": round(elapsed, 3),
+                "rows_per_s": round(swipers * per_swiper / elapsed, 1)}
+
+    result = {}
+    for n, mode in enumerate(("commit_per_row", "group_commit", "group_commit_durable")):
+        batches = main.database.batches
+        result[mode] = await run(mode, (n + 1) * 10 ** 6)
+        result[mode]["commits"] = main.database.batches - batches if mode != "commit_per_row" else result[mode]["rows"]
+    result["synchronous"] = main.DB_SYNCHRONOUS
+    await main.database.close()
+    return result
+
+
+# === Локальная замена Bot API ===
+class FakeBotAPI:
+    # Отвечает на любой метод как Telegram. flood — доля запросов, на которые
+    # отвечаем 429 с retry_after, как при настоящем флуд-контроле.
+    def __init__(self, flood: float = 0.0, retry_after: int = 1, forbidden=()):
+        self.flood = flood
+        self.retry_after = retry_after
+        self.forbidden = set(forbidden)  # эти чаты «заблокировали бота» — ответ 403
+        self.calls = {}     # method -> count
+        self.received = {}  # chat_id -> [text, ...] в порядке доставки
+        self.rng = random.Random(7)
+        self.runner = None
+        self.url = None
+
+    async def handle(self, request: web.Request):
+        method = request.match_info["method"]
+        data = dict(await request.post())
+        if self.flood and method.startswith(("send", "copy")) and self.rng.random() < self.flood:
+            return web.json_response({"ok": False, "error_code": 429, "description": "Too Many Requests",
+                                      "parameters": {"retry_after": self.retry_after}}, status=429)
+        chat_id = int(data.get("chat_id", 0) or 0)
+        if chat_id in self.forbidden:
+            return web.json_response({"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"},
+                                     status=403)
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if "text" in data:
+            self.received.setdefault(chat_id, []).append(data["text"])
+        elif method == "sendMediaGroup":
+            self.received.setdefault(chat_id, []).append(f"album:{len(json.loads(data['media']))}")
+        elif method.startswith(("send", "copy")):
+            self.received.setdefault(chat_id, []).append(method)
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif method.startswith(("send", "copy", "edit")):
+            result = {"message_id": self.calls[method], "date": int(time.time()),
+                      "chat": {"id": chat_id, "type": "private"}, "text": data.get("text", "")}
+            if method == "sendMediaGroup":
+                result = [result]
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+
+    def bot(self) -> Bot:
+        return Bot(token="123456:bench", session=AiohttpSession(api=TelegramAPIServer.from_base(self.url)))
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+# === Очередь отправки: лимиты, 429 и порядок внутри чата ===
+async def bench_outbox(args):
+    api = FakeBotAPI(flood=args.flood)
+    await api.start()
+    bot = api.bot()
+    main.SEND_RATE = args.rate
+    outbox = main.Outbox()
+    outbox.start()
+    chats = max(1, args.ops // 20)
+    t = time.perf_counter()
+    for i in range(args.ops):
+        outbox.send(1000 + i % chats, bot.send_message, str(i))
+    while outbox.chats:
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - t
+    await outbox.stop()
+    await bot.session.close()
+    await api.stop()
+    out_of_order = sum(1 for texts in api.received.values() for a, b in zip(texts, texts[1:]) if int(a) > int(b))
+    violations = []
+    if out_of_order:
+        violations.append(f"нарушен порядок внутри чата: {out_of_order} раз")
+    if outbox.failed or outbox.sent != args.ops:
+        violations.append(f"доставлено {outbox.sent} из {args.ops}, ошибок {outbox.failed}")
+    return {
+        "messages": args.ops,
+        "chats": chats,
+        "delivered": outbox.sent,
+        "failed": outbox.failed,
+        "out_of_order": out_of_order,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_per_s": round(outbox.sent / elapsed, 1),
+        "violations": violations,
+    }
+
+
+# === Нагрузочный прогон: синтетическая база + сценарии апдейтов через Dispatcher ===
+def generate_db(path: str, users: int, blocks: int, likes: int, seed: int = 1):
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    for _, statements in main.MIGRATIONS:
+        for sql in statements:
+            conn.execute(sql)
+    conn.execute(f"PRAGMA user_version = {main.MIGRATIONS[-1][0]}")
+    conn.executemany(
+        "INSERT OR REPLACE INTO users (user_id, gender, pref_gender, age, pref_age_min, pref_age_max, boost_until) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        ((uid, rng.choice("mf"), rng.choice(["m", "f", "all"]), rng.randint(18, 50), 18, 50,
+          int(time.time()) + 86400 if rng.random() < 0.02 else 0) for uid in range(1, users + 1)))
+    conn.executemany("INSERT OR IGNORE INTO blocks (blocker_id, blocked_id) VALUES (?, ?)",
+                     ((rng.randint(1, users), rng.randint(1, users)) for _ in range(blocks)))
+    conn.executemany("INSERT OR IGNORE INTO likes (liker_id, liked_id, created_at) VALUES (?, ?, ?)",
+                     ((rng.randint(1, users), rng.randint(1, users), int(time.time()) - rng.randint(0, 10 ** 6)) for _ in range(likes)))
+    conn.commit()
+    conn.close()
+
+
+class Updates:
+    # Собирает апдейты так, как их прислал бы Telegram
+    def __init__(self, bot: Bot):
+        self.bot = bot
+        self.next_id = 0
+
+    def _id(self):
+        self.next_id += 1
+        return self.next_id
+
+    def _user(self, uid):
+        return {"id": uid, "is_bot": False, "first_name": f"user{uid}", "username": f"user{uid}"}
+
+    def message(self, uid: int, text: str):
+        message = {"message_id": self._id(), "date": int(time.time()), "chat": {"id": uid, "type": "private"},
+                   "from": self._user(uid), "text": text}
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return types.Update.model_validate({"update_id": self._id(), "message": message}, context={"bot": self.bot})
+
+    def photo(self, uid: int, media_group_id: str = None):
+        message = {"message_id": self._id(), "date": int(time.time()), "chat": {"id": uid, "type": "private"},
+                   "from": self._user(uid), "photo": [{"file_id": f"photo{self.next_id}", "file_unique_id": f"u{self.next_id}",
+                                                       "width": 90, "height": 90}]}
+        if media_group_id:
+            message["media_group_id"] = media_group_id
+        return types.Update.model_validate({"update_id": self._id(), "message": message}, context={"bot": self.bot})
+
+    def callback(self, uid: int, data: str):
+        bot_message = {"message_id": self._id(), "date": int(time.time()), "chat": {"id": uid, "type": "private"},
+                       "from": {"id": 1, "is_bot": True, "first_name": "bench"}, "text": "..."}
+        query = {"id": str(self._id()), "from": self._user(uid), "chat_instance": "1", "data": data, "message": bot_message}
+        return types.Update.model_validate({"update_id": self._id(), "callback_query": query}, context={"bot": self.bot})
+
+
+def scenarios(updates: Updates, users: int, ops: int, rng: random.Random):
+    # Каждый сценарий — {user_id: [(шаг, апдейт), ...]}: шаги одного пользователя идут по порядку
+    registration = {}
+    for uid in range(users + 1, users + 1 + max(1, ops // 6)):
+        registration[uid] = [("start", updates.message(uid, "/start")),
+                             ("gender", updates.callback(uid, "gender_f")),
+                             ("pref_gender", updates.callback(uid, "pref_m")),
+                             ("age", updates.message(uid, "25")),
+                             ("min_age", updates.message(uid, "20")),
+                             ("max_age", updates.message(uid, "40"))]
+    swipes = {}
+    for _ in range(ops):
+        uid = rng.randint(1, users)
+        target = rng.randint(1, users)
+        steps = swipes.setdefault(uid, [])
+        if not steps or rng.random() < 0.2:
+            steps.append(("search", updates.message(uid, "/search")))
+        steps.append(("like", updates.callback(uid, f"like_{target}")) if rng.random() < 0.3
+                     else ("dislike", updates.callback(uid, f"dislike_{target}")))
+    relay = {}
+    pairs = max(1, min(users // 2, ops // 20))
+    for _ in range(ops):
+        pair = rng.randrange(pairs)
+        uid = 2 * pair + 1 + rng.randint(0, 1)
+        relay.setdefault(uid, []).append(("relay", updates.message(uid, f"привет {rng.random()}")))
+    premium = {}
+    for _ in range(max(1, ops // 5)):
+        uid = rng.randint(1, users)
+        premium.setdefault(uid, []).append(("premium", updates.callback(uid, rng.choice(["buy_vip", "buy_boost", "buy_superlike"]))))
+        if rng.random() < 0.2:
+            premium[uid].append(("rebus", updates.message(uid, "/9889")))
+    return {"registration": registration, "swipes": swipes, "relay": relay, "premium": premium}, pairs
+
+
+async def run_scenario(streams, concurrency: int):
+    latencies = {}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def user_stream(steps):
+        async with semaphore:
+            for step, update in steps:
+                t = time.perf_counter()
+                await main.dp.feed_update(main.bot, update)
+                latencies.setdefault(step, []).append(time.perf_counter() - t)
+
+    main.metrics.histograms.clear()
+    total = sum(len(steps) for steps in streams.values())
+    t = time.perf_counter()
+    await asyncio.gather(*(user_stream(steps) for steps in streams.values()))
+    elapsed = time.perf_counter() - t
+    return {
+        "updates": total,
+        "elapsed_s": round(elapsed, 3),
+        "updates_per_s": round(total / elapsed, 1),
+        "steps": {step: percentiles(samples) for step, samples in sorted(latencies.items())},
+        "handlers": {name: {"count": count, "p50_ms": p50 * 1000, "p95_ms": p95 * 1000, "p99_ms": p99 * 1000}
+                     for name, count, p50, p95, p99 in main.metrics.summary("handler", top=50)},
+        "db": {name: {"count": count, "p50_ms": p50 * 1000, "p99_ms": p99 * 1000}
+               for name, count, p50, p95, p99 in main.metrics.summary("db", top=10)},
+        "api": {name: {"count": count, "p50_ms": p50 * 1000, "p99_ms": p99 * 1000}
+                for name, count, p50, p95, p99 in main.metrics.summary("api", top=10)},
+    }
+
+
+async def bench_load(args):
+    generate_db(main.DB_NAME, args.users, args.blocks, args.likes)
+    api = FakeBotAPI()
+    await api.start()
+    main.bot = api.bot()
+    # Меряем сам бот, а не лимиты Telegram: снимаем ограничения очереди отправки
+    main.outbox.global_bucket = main.TokenBucket(10 ** 6, 10 ** 6)
+    main.SEND_CHAT_RATE = main.SEND_CHAT_BURST = 10 ** 6
+    t = time.perf_counter()
+    await main.startup()
+    startup_s = time.perf_counter() - t
+
+    rng = random.Random(args.seed)
+    streams, pairs = scenarios(Updates(main.bot), args.users, args.ops, rng)
+    for pair in range(pairs):
+        await main.chat_store.connect(2 * pair + 1, 2 * pair + 2)
+
+    result = {"users": args.users, "blocks": args.blocks, "likes": args.likes, "ops": args.ops,
+              "concurrency": args.concurrency, "startup_s": round(startup_s, 3),
+              "startup_stages_s": {stage: round(seconds, 3) for stage, seconds in main.startup_stats.items()},
+              "scenarios": {}}
+    for name, user_streams in streams.items():
+        result["scenarios"][name] = await run_scenario(user_streams, args.concurrency)
+    result["api_calls"] = dict(sorted(api.calls.items()))
+    await main.shutdown()
+    await main.bot.session.close()
+    await api.stop()
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    return result
+
+
+# === Рассылка: скорость, прерывание и продолжение без повторов ===
+async def bench_broadcast(args):
+    generate_db(main.DB_NAME, args.users, 0, 0)
+    forbidden = set(random.Random(args.seed).sample(range(1, args.users + 1), args.users // 20))
+    api = FakeBotAPI(forbidden=forbidden)
+    await api.start()
+    main.bot = api.bot()
+    main.outbox.global_bucket = main.TokenBucket(args.rate, args.rate)
+    main.broadcaster.bucket = main.TokenBucket(args.rate, args.rate)
+    await main.startup()
+
+    t = time.perf_counter()
+    await main.broadcaster.start("📣 bench")
+    await asyncio.sleep(args.interrupt)
+    await main.broadcaster.stop()
+    await main.database.flush_writes()
+    interrupted_at = api.calls.get("sendMessage", 0)
+    await main.broadcaster.resume()
+    # Второй воркер на той же базе: аренда свежая — подхватывать он не должен
+    other = main.Broadcaster(main.database)
+    await other.resume()
+    double_claim = other.running()
+    await other.stop()
+    await main.broadcaster.task
+    elapsed = time.perf_counter() - t
+
+    delivered = [chat_id for chat_id, texts in api.received.items() for text in texts if text == "📣 bench"]
+    blocked = (await main.database.fetchone("SELECT COUNT(*) FROM users WHERE bot_blocked = 1"))[0]
+    # Отписавшийся снова написал боту — следующая рассылка должна до него дойти
+    returned = min(forbidden)
+    api.forbidden.discard(returned)
+    await main.dp.feed_update(main.bot, Updates(main.bot).message(returned, "/help"))
+    await main.database.flush_writes()
+    row = await main.database.fetchone("SELECT bot_blocked FROM users WHERE user_id = ?", (returned,))
+    # 429 в рассылке должен остановить и общее ведро — иначе обычные сообщения продолжат флудить
+    api.flood = 1.0
+    send = asyncio.create_task(main.broadcaster._send(0, returned, "📣 429", asyncio.Semaphore(1)))
+    await asyncio.sleep(0.1)
+    global_paused = main.outbox.global_bucket.paused_until > time.monotonic()
+    api.flood = 0.0
+    await send
+    violations = [] if len(delivered) == len(set(delivered)) else ["есть повторные отправки"]
+    if double_claim:
+        violations.append("прерванную рассылку подхватили два воркера")
+    if not global_paused:
+        violations.append("после 429 в рассылке общее ведро не на паузе")
+    if blocked != len(forbidden):
+        violations.append(f"помечено {blocked} заблокировавших вместо {len(forbidden)}")
+    if row[0]:
+        violations.append(f"у {returned} bot_blocked не сброшен после его апдейта")
+    await main.shutdown()
+    await main.bot.session.close()
+    await api.stop()
+    return {
+        "recipients": args.users,
+        "forbidden": len(forbidden),
+        "sent_before_interrupt": interrupted_at,
+        "delivered": len(delivered),
+        "duplicates": len(delivered) - len(set(delivered)),
+        "marked_blocked": blocked,
+        "violations": violations,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_per_s": round(len(delivered) / elapsed, 1),
+    }
+
+
+# === Альбомы: полный, по таймауту, лимит незавершённых и конец чата ===
+async def bench_albums(args):
+    generate_db(main.DB_NAME, 10, 0, 0)
+    api = FakeBotAPI()
+    await api.start()
+    main.bot = api.bot()
+    main.outbox.global_bucket = main.TokenBucket(10 ** 6, 10 ** 6)
+    main.SEND_CHAT_RATE = main.SEND_CHAT_BURST = 10 ** 6
+    main.ALBUM_WAIT = 0.2
+    await main.startup()
+    updates = Updates(main.bot)
+    groups = main.album_buffer.groups
+    for pair in range(5):
+        await main.chat_store.connect(2 * pair + 1, 2 * pair + 2)
+
+    async def feed(*items):
+        for update in items:
+            await main.dp.feed_update(main.bot, update)
+
+    async def delivered():
+        while main.outbox.chats:
+            await asyncio.sleep(0.01)
+
+    violations = []
+    # 1 -> 2: десятая часть отправляет альбом сразу, не дожидаясь таймаута
+    await feed(*(updates.photo(1, "full") for _ in range(main.ALBUM_MAX_ITEMS)))
+    if (1, "full") in groups:
+        violations.append(f"альбом из {main.ALBUM_MAX_ITEMS} частей ждёт таймаута")
+    # 3 -> 4: неполный альбом уходит по таймауту
+    await feed(*(updates.photo(3, "part") for _ in range(3)))
+    if (3, "part") not in groups:
+        violations.append("неполный альбом ушёл раньше таймаута")
+    await asyncio.sleep(main.ALBUM_WAIT * 2)
+    if (3, "part") in groups:
+        violations.append("неполный альбом не ушёл по таймауту")
+    # 5 -> 6: сверх ALBUM_MAX_PENDING самый старый альбом уходит сразу
+    cap, main.ALBUM_MAX_PENDING = main.ALBUM_MAX_PENDING, 3
+    await feed(*(updates.photo(5, f"cap{i}") for i in range(main.ALBUM_MAX_PENDING + 1)))
+    if len(groups) > main.ALBUM_MAX_PENDING or (5, "cap0") in groups:
+        violations.append(f"незавершённых альбомов {len(groups)} при лимите {main.ALBUM_MAX_PENDING}")
+    main.ALBUM_MAX_PENDING = cap
+    # 7 -> 8 и 9 -> 10: /stop и /reset сразу после альбома — альбом должен прийти до уведомления
+    await feed(updates.photo(7, "stop"), updates.photo(7, "stop"), updates.message(7, "/stop"),
+               updates.photo(9, "reset"), updates.photo(9, "reset"), updates.message(9, "/reset"))
+    await asyncio.sleep(main.ALBUM_WAIT * 2)
+    await delivered()
+    expected = {
+        2: ["album:10"],
+        4: ["album:3"],
+        6: ["sendPhoto"] * 4,
+        8: ["album:2", "Собеседник завершил чат."],
+        10: ["album:2", "Собеседник удалил профиль."],
+    }
+    for chat_id, messages in expected.items():
+        if api.received.get(chat_id) != messages:
+            violations.append(f"чат {chat_id}: {api.received.get(chat_id)} вместо {messages}")
+    await main.shutdown()
+    await main.bot.session.close()
+    await api.stop()
+    return {"albums_sent": api.calls.get("sendMediaGroup", 0), "singles_sent": api.calls.get("sendPhoto", 0),
+            "violations": violations}
+
+
+# === Истечение VIP и бустов: подменённые часы вместо ожидания реального срока ===
+async def bench_expiry(args):
+    start = int(time.time())
+    clock = [start]
+    generate_db(main.DB_NAME, 10, 0, 0)
+    # 1 — VIP до +100, 2 — буст до +100, 3 — буст до +100, который продлят до +300,
+    # 4 — VIP до +100, который станет вечным
+    with sqlite3.connect(main.DB_NAME) as conn:
+        conn.execute("UPDATE users SET boost_until = 0")
+        conn.executemany("UPDATE users SET is_vip = 1, vip_until = ? WHERE user_id = ?", [(start + 100, 1), (start + 100, 4)])
+        conn.executemany("UPDATE users SET boost_until = ? WHERE user_id = ?", [(start + 100, 2), (start + 100, 3)])
+    main.expiry = main.ExpiryScheduler(main.database, clock=lambda: clock[0])
+    await main.database.open()
+    await main.warm_up()
+
+    # Продление и вечный VIP — как в обработчиках покупки
+    await main.database.execute("UPDATE users SET boost_until = ? WHERE user_id = ?", (start + 300, 3))
+    main.expiry.schedule(3, "boost", start + 300)
+    await main.database.execute("UPDATE users SET is_vip = 1, vip_until = 0 WHERE user_id = ?", (4,))
+    main.expiry.cancel(4, "vip")
+    for uid in (3, 4):
+        main.profile_cache.invalidate(uid)
+
+    violations = []
+
+    async def check(at, vip, boosted):
+        clock[0] = start + at
+        await main.expiry.run_due()
+        for uid in (1, 4):
+            row = await main.database.fetchone("SELECT is_vip FROM users WHERE user_id = ?", (uid,))
+            active = await main.is_vip_active(uid)
+            if active != (uid in vip) or bool(row[0]) != (uid in vip):
+                violations.append(f"+{at}s: у {uid} VIP {active} (в базе is_vip={row[0]}), ожидали {uid in vip}")
+        for uid in (2, 3):
+            row = await main.database.fetchone("SELECT boost_until FROM users WHERE user_id = ?", (uid,))
+            in_index = main.match_index.profiles[uid][5]
+            if in_index != (uid in boosted) or (row[0] > 0) != (uid in boosted):
+                violations.append(f"+{at}s: у {uid} буст {in_index} (в базе boost_until={row[0]}), ожидали {uid in boosted}")
+
+    await check(99, vip={1, 4}, boosted={2, 3})
+
+    # Коммит снятия упал (SQLITE_BUSY от соседнего процесса) — сроки не должны потеряться
+    clock[0] = start + 101
+    transaction = main.database.transaction
+
+    def busy():
+        main.database.transaction = transaction
+        raise sqlite3.OperationalError("database is locked")
+
+    main.database.transaction = busy
+    try:
+        await main.expiry.run_due()
+        violations.append("run_due не передал ошибку коммита")
+    except sqlite3.OperationalError:
+        pass
+    await check(101, vip={4}, boosted={3})
+    await check(301, vip={4}, boosted=set())
+    await check(10 ** 6, vip={4}, boosted=set())
+    result = {"expired": main.expiry.expired, "heap_left": len(main.expiry.heap), "violations": violations}
+    await main.database.close()
+    return result
+
+
+# === Планы запросов: ни один запрос обработчиков не должен сканировать таблицу ===
+# Запросы не переписываются сюда руками: прогоняем сценарии через Dispatcher и
+# собираем всё, что реально выполнили соединения бота (sqlite3 trace callback).
+# Полные проходы допустимы только там, где они задуманы: прогрев при старте, /debug и рассылка.
+FULL_SCAN_ALLOWED = {
+    "SELECT * FROM users",
+    "SELECT blocker_id, blocked_id FROM blocks ORDER BY blocker_id, blocked_id",
+    "SELECT user_id, partner_id FROM chat_sessions",
+    "SELECT COUNT(*) FROM users",
+    "SELECT COUNT(*) FROM users WHERE bot_blocked = ?",
+    "SELECT id FROM broadcasts WHERE status = ? AND claimed_at < ? ORDER BY id LIMIT ?",
+}
+
+SQL_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+def normalize_sql(sql: str) -> str:
+    # Trace отдаёт запрос с подставленными значениями — сводим их обратно к ?
+    return SQL_LITERAL.sub("?", " ".join(sql.split()))
+
+
+def plan_streams(updates: Updates, users: int):
+    # Команды, которых нет в нагрузочных сценариях, — по разу на каждую
+    admin = main.ADMIN_ID
+    return {
+        admin: [("debug", updates.message(admin, "/debug")), ("broadcast", updates.message(admin, "/broadcast plans"))],
+        1: [("help", updates.message(1, "/help")), ("fans", updates.message(1, "/fans")),
+            ("fans_page", updates.callback(1, f"fans_{int(time.time())}_{users}")),
+            ("like_cmd", updates.message(1, "/like")), ("rematch", updates.callback(1, "rematch_2")),
+            ("stop", updates.message(1, "/stop")), ("feedback_like", updates.callback(1, "feedback_like_2")),
+            ("feedback_dislike", updates.callback(1, "feedback_dislike_3")), ("premium", updates.message(1, "/premium")),
+            ("reset", updates.message(1, "/reset"))],
+        2: [("feedback_like", updates.callback(2, "feedback_like_1")), ("rebus", updates.message(2, "/9889"))],
+    }
+
+
+async def bench_plans(args):
+    # Старая база без версии схемы (как до миграций) должна обновиться на месте
+    path = os.path.join(tempfile.mkdtemp(), "plans.db")
+    with sqlite3.connect(path) as conn:
+        conn.executescript(main.MIGRATIONS[0][1][0] + ";" + main.MIGRATIONS[0][1][1] + ";")
+        conn.execute("INSERT INTO users (user_id, gender, pref_gender, age, pref_age_min, pref_age_max) VALUES (1, 'm', 'f', 20, 18, 30)")
+    database = main.database
+    main.database = main.Database(path)
+    await main.database.open()
+    await main.init_db()
+    await main.database.close()
+    main.database = database
+    with sqlite3.connect(path) as conn:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        users_kept = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    # Все запросы живого бота на синтетической базе
+    users = 500
+    generate_db(main.DB_NAME, users, users * 5, users * 5)
+    # Отписавшийся от бота — вне сценариев, его увидит только рассылка
+    blocked_bot = 10 ** 6
+    with sqlite3.connect(main.DB_NAME) as conn:
+        conn.execute("INSERT INTO users (user_id, gender, pref_gender, age, pref_age_min, pref_age_max) VALUES (?, 'm', 'f', 20, 18, 30)",
+                     (blocked_bot,))
+    executed = {}
+
+    def trace(sql):
+        if sql.lstrip().split(None, 1)[0].upper() in ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH"):
+            executed.setdefault(normalize_sql(sql), sql)
+
+    connect = main.database._connect
+
+    async def traced_connect():
+        conn = await connect()
+        await conn.set_trace_callback(trace)
+        return conn
+
+    main.database._connect = traced_connect
+    api = FakeBotAPI(forbidden={blocked_bot})
+    await api.start()
+    main.bot = api.bot()
+    await main.startup()
+    updates = Updates(main.bot)
+    streams, pairs = scenarios(updates, users, 200, random.Random(args.seed))
+    for pair in range(pairs):
+        await main.chat_store.connect(2 * pair + 1, 2 * pair + 2)
+    for user_streams in (*streams.values(), plan_streams(updates, users)):
+        await run_scenario(user_streams, args.concurrency)
+    if main.broadcaster.running():
+        await main.broadcaster.task
+    now = int(time.time())
+    main.expiry.schedule(5, "vip", now - 1)
+    main.expiry.schedule(6, "boost", now - 1)
+    await main.expiry.run_due()
+    await main.storage.expire()
+    await main.storage.flush()
+    await main.shutdown()
+    await api.stop()
+
+    scans = {}
+    with sqlite3.connect(main.DB_NAME) as conn:
+        for normalized, sql in sorted(executed.items()):
+            plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql)]
+            bad = [step for step in plan if step.startswith("SCAN ") and "CONSTANT ROW" not in step]
+            if bad and normalized not in FULL_SCAN_ALLOWED:
+                scans[normalized] = bad
+    return {"schema_version": version, "users_kept": users_kept, "checked": len(executed),
+            "full_scans": scans, "unused_allowances": sorted(FULL_SCAN_ALLOWED - set(executed))}
+
+
+BENCHES = {"db": bench_db, "expiry": bench_expiry, "match": bench_match, "outbox": bench_outbox, "plans": bench_plans, "writes": bench_writes, "load": bench_load,
+           "broadcast": bench_broadcast, "albums": bench_albums}
+
+
+def cli():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарки бота")
+    parser.add_argument("bench", choices=sorted(BENCHES))
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--ops", type=int, default=2000)
+    parser.add_argument("--blocks", type=int, default=50000)
+    parser.add_argument("--likes", type=int, default=50000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--interrupt", type=float, default=1.0, help="через сколько секунд прервать рассылку")
+    parser.add_argument("--out", help="сохранить результат в JSON, чтобы сравнивать сборки")
+    parser.add_argument("--flood", type=float, default=0.05, help="доля ответов 429 от фейкового Bot API")
+    parser.add_argument("--rate", type=float, default=main.SEND_RATE, help="глобальный лимит отправки в секунду")
+    args = parser.parse_args()
+    result = asyncio.run(BENCHES[args.bench](args))
+    print(json.dumps({"bench": args.bench, "result": result}, ensure_ascii=False, indent=2))
+    if result.get("full_scans") or result.get("violations"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
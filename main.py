@@ -1,22 +1,36 @@
+import time
+STARTED_AT = time.perf_counter()  # от начала импорта — для метрики готовности
+
 import asyncio
+import aiohttp
 import aiosqlite
+import heapq
+import json
+import logging
 import os
-import time
-from aiogram import Bot, Dispatcher, types, F
+import signal
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from aiogram import BaseMiddleware, Bot, Dispatcher, types, F
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import (TelegramAPIError, TelegramForbiddenError, TelegramNetworkError,
+                                TelegramRetryAfter, TelegramServerError)
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
-from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, LabeledPrice
-from random import choice
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from aiogram.types import (InlineKeyboardMarkup, InlineKeyboardButton, InputMediaAudio,
+                           InputMediaDocument, InputMediaPhoto, InputMediaVideo)
+import random
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from itertools import groupby
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
 
-DB_NAME = "dating.db"
-active_chats = {}
+DB_NAME = os.getenv("DB_NAME", "dating.db")
+log = logging.getLogger(__name__)
 
 # === НАСТРОЙКИ ===
 ADMIN_ID = 5761885649
@@ -26,6 +40,27 @@ CRYPTO_PROVIDER_TOKEN = "401643678:TEST:12345"  # ТЕСТОВЫЙ ТОКЕН TE
 VIP_PRICE = 14900
 BOOST_PRICE = 4900
 SUPERLIKE_PRICE = 2900
+BOOST_WEIGHT = 10  # во сколько раз анкета с бустом чаще попадается в поиске
+
+# Режим работы: polling (по умолчанию) или webhook
+SERVE_MODE = os.getenv("SERVE_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # публичный адрес; если задан — регистрируем вебхук в Telegram
+WEBHOOK_PATH = "/webhook"
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_CONCURRENCY = 64    # апдейтов обрабатывается одновременно
+WEBHOOK_MAX_PENDING = 5000  # больше — отвечаем 503, Telegram пришлёт повторно
+
+# Активные чаты: sqlite (переживают рестарт) или memory
+CHAT_STORE = os.getenv("CHAT_STORE", "sqlite")
+# Несколько процессов на одном хосте и одной базе — только в режиме webhook: процесс N слушает
+# WEBHOOK_PORT + N и пересылает апдейты чужих пользователей (chat_shard) их владельцу
+CHAT_WORKERS = int(os.getenv("CHAT_WORKERS", "1"))      # процессов бота на одной базе
+CHAT_WORKER_ID = int(os.getenv("CHAT_WORKER_ID", "0"))  # номер этого процесса
+CHAT_CACHE_TTL = 2  # секунд; партнёра своего пользователя может поменять и чужой процесс (лайк, /stop)
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # Prometheus на 127.0.0.1:порт; 0 — выключено
 
 class Reg(StatesGroup):
     gender = State()
@@ -34,94 +69,1485 @@ class Reg(StatesGroup):
     pref_age_min = State()
     pref_age_max = State()
 
+# === МЕТРИКИ ===
+# Границы корзин гистограмм общие и заданы заранее: запись — bisect и инкремент в списке.
+HISTOGRAM_BOUNDS = tuple(0.0001 * 2 ** i for i in range(18))  # 0.1 мс … ~13 с
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float):
+        self.counts[bisect_left(HISTOGRAM_BOUNDS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        # Верхняя граница корзины, в которую попал q-й процентиль
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return HISTOGRAM_BOUNDS[min(i, len(HISTOGRAM_BOUNDS) - 1)]
+        return 0.0
+
+class Metrics:
+    def __init__(self):
+        self.histograms = {}  # (семейство, имя) -> Histogram
+        self.counters = {}    # (семейство, имя) -> int
+        self.gauges = {}      # семейство -> функция без аргументов
+
+    def observe(self, family: str, name: str, seconds: float):
+        histogram = self.histograms.get((family, name))
+        if histogram is None:
+            histogram = self.histograms[(family, name)] = Histogram()
+        histogram.observe(seconds)
+
+    def inc(self, family: str, name: str, n: int = 1):
+        self.counters[(family, name)] = self.counters.get((family, name), 0) + n
+
+    def summary(self, family: str, top: int = 8):
+        rows = [(name, h) for (f, name), h in self.histograms.items() if f == family]
+        rows.sort(key=lambda row: row[1].sum, reverse=True)
+        return [(name, h.count, h.quantile(0.5), h.quantile(0.95), h.quantile(0.99)) for name, h in rows[:top]]
+
+    def prometheus(self) -> str:
+        lines = []
+        for (family, name), h in sorted(self.histograms.items()):
+            label = name.replace("\\", "\\\\").replace('"', '\\"')
+            cumulative = 0
+            for bound, n in zip(HISTOGRAM_BOUNDS, h.counts):
+                cumulative += n
+                lines.append(f'bot_{family}_seconds_bucket{{name="{label}",le="{bound:g}"}} {cumulative}')
+            lines.append(f'bot_{family}_seconds_bucket{{name="{label}",le="+Inf"}} {h.count}')
+            lines.append(f'bot_{family}_seconds_sum{{name="{label}"}} {h.sum}')
+            lines.append(f'bot_{family}_seconds_count{{name="{label}"}} {h.count}')
+        for (family, name), value in sorted(self.counters.items()):
+            lines.append(f'bot_{family}_total{{name="{name}"}} {value}')
+        for family, read in sorted(self.gauges.items()):
+            lines.append(f"bot_{family} {read()}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+_sql_labels = {}
+
+def sql_label(sql: str) -> str:
+    label = _sql_labels.get(sql)
+    if label is None:
+        label = _sql_labels[sql] = " ".join(sql.split())[:80]
+    return label
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        name = data["handler"].callback.__name__
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            metrics.inc("handler_errors", name)
+            raise
+        finally:
+            metrics.observe("handler", name, time.perf_counter() - start)
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        start = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            metrics.inc("api_errors", f"{name}:{type(e).__name__}")
+            raise
+        finally:
+            metrics.observe("api", name, time.perf_counter() - start)
+
+async def metrics_handler(request):
+    from aiohttp import web
+    return web.Response(text=metrics.prometheus(), content_type="text/plain", charset="utf-8")
+
+async def start_metrics_server():
+    from aiohttp import web  # сервер нужен только с METRICS_PORT или в режиме вебхука
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", METRICS_PORT).start()
+    return runner
+
+# === БАЗА ДАННЫХ ===
+DB_READERS = 4
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")  # FULL — fsync на каждый коммит
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    f"PRAGMA synchronous={DB_SYNCHRONOUS}",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+)
+DB_BATCH_INTERVAL = 0.005  # секунд копим отложенные записи перед общим коммитом
+DB_BATCH_ROWS = 200        # или пока не наберётся столько строк
+DB_DURABLE_WRITES = os.getenv("DB_DURABLE_WRITES", "0") == "1"  # хендлер ждёт коммита своей пачки
+
+class TimedCall:
+    # aiosqlite.execute* можно и await'ить, и открывать через async with — поддерживаем оба
+    def __init__(self, call, sql: str):
+        self.call = call
+        self.sql = sql
+        self.cursor = None
+
+    def __await__(self):
+        return self._run().__await__()
+
+    async def _run(self):
+        start = time.perf_counter()
+        try:
+            return await self.call
+        finally:
+            metrics.observe("db", sql_label(self.sql), time.perf_counter() - start)
+
+    async def __aenter__(self):
+        self.cursor = await self._run()
+        return self.cursor
+
+    async def __aexit__(self, *exc):
+        await self.cursor.close()
+
+class TimedConnection:
+    # Соединение писателя внутри transaction(): каждый запрос попадает в метрики db
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql: str, params=()):
+        return TimedCall(self.conn.execute(sql, params), sql)
+
+    def executemany(self, sql: str, params):
+        return TimedCall(self.conn.executemany(sql, params), sql)
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+class Database:
+    # Один писатель + небольшой пул читателей. Соединения живут всё время работы бота,
+    # sqlite3 кэширует подготовленные запросы на каждом соединении (cached_statements).
+    def __init__(self, path: str, readers: int = DB_READERS):
+        self.path = path
+        self.readers_count = readers
+        self.writer = None
+        self._readers = asyncio.Queue()
+        self._write_lock = asyncio.Lock()
+        self._batch = []  # [(sql, params, future | None)] — отложенные записи (write_behind)
+        self._batch_first = asyncio.Event()
+        self._batch_full = asyncio.Event()
+        self._batch_task = None
+        self.batches = 0
+        self.batched_rows = 0
+
+    async def _connect(self):
+        conn = await aiosqlite.connect(self.path, cached_statements=256)
+        for pragma in DB_PRAGMAS:
+            await conn.execute(pragma)
+        return conn
+
+    async def open(self):
+        self.writer = await self._connect()
+        for _ in range(self.readers_count):
+            self._readers.put_nowait(await self._connect())
+        self._batch_task = asyncio.create_task(self._batch_loop())
+
+    async def close(self):
+        if self._batch_task:
+            self._batch_task.cancel()
+            try:
+                await self._batch_task
+            except asyncio.CancelledError:
+                pass
+            self._batch_task = None
+            await self.flush_writes()
+        while not self._readers.empty():
+            await self._readers.get_nowait().close()
+        if self.writer:
+            await self.writer.close()
+            self.writer = None
+
+    @asynccontextmanager
+    async def reader(self):
+        conn = await self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def transaction(self):
+        # Все записи идут через одно соединение по очереди. Накопленные write_behind
+        # выполняются первыми в той же транзакции — порядок записей не нарушается.
+        # BEGIN IMMEDIATE берёт блокировку записи сразу: иначе sqlite3 начнёт транзакцию
+        # только на первом INSERT/DELETE, и чтение перед ним (SELECT партнёра в чатах)
+        # другой процесс на той же базе успеет изменить.
+        async with self._write_lock:
+            await self.writer.execute("BEGIN IMMEDIATE")
+            batch, self._batch = self._batch, []
+            if batch:
+                start = time.perf_counter()
+                try:
+                    await self._apply(batch)
+                    metrics.observe("db", "write_behind batch", time.perf_counter() - start)
+                except Exception as e:
+                    await self.writer.rollback()
+                    self._settle(batch, e)
+                    batch = []
+                    await self.writer.execute("BEGIN IMMEDIATE")
+            try:
+                yield TimedConnection(self.writer)
+                start = time.perf_counter()
+                await self.writer.commit()
+                metrics.observe("db", "COMMIT", time.perf_counter() - start)
+            except BaseException:
+                await self.writer.rollback()
+                # Строки пачки не виноваты в ошибке — вернём их в начало очереди
+                self._batch[:0] = batch
+                if self._batch:
+                    self._batch_first.set()
+                raise
+            self._settle(batch, None)
+
+    async def _apply(self, batch):
+        # Подряд идущие одинаковые запросы — одним executemany
+        i = 0
+        while i < len(batch):
+            j = i
+            while j < len(batch) and batch[j][0] == batch[i][0]:
+                j += 1
+            await self.writer.executemany(batch[i][0], [params for _, params, _ in batch[i:j]])
+            i = j
+
+    def _settle(self, batch, error):
+        if not batch:
+            return
+        if error is None:
+            self.batches += 1
+            self.batched_rows += len(batch)
+        else:
+            log.error("Пачка отложенных записей (%s шт.) не сохранена: %r", len(batch), error)
+        for _, _, future in batch:
+            if future is not None and not future.done():
+                if error is None:
+                    future.set_result(None)
+                else:
+                    future.set_exception(error)
+
+    async def write_behind(self, sql: str, params=(), wait: bool = False):
+        # Запись уйдёт общим коммитом через DB_BATCH_INTERVAL или по DB_BATCH_ROWS строк.
+        # wait=True (или DB_DURABLE_WRITES) — вернуться только после коммита.
+        future = asyncio.get_running_loop().create_future() if wait or DB_DURABLE_WRITES else None
+        self._batch.append((sql, params, future))
+        if len(self._batch) == 1:
+            self._batch_first.set()
+        if len(self._batch) >= DB_BATCH_ROWS:
+            self._batch_full.set()
+        if future is not None:
+            await future
+
+    async def flush_writes(self):
+        # Через блокировку писателя: дожидаемся и пачки, которую уже коммитит фоновая задача
+        async with self.transaction():
+            pass
+
+    async def _batch_loop(self):
+        while True:
+            await self._batch_first.wait()
+            if len(self._batch) < DB_BATCH_ROWS:
+                try:
+                    await asyncio.wait_for(self._batch_full.wait(), DB_BATCH_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+            self._batch_first.clear()
+            self._batch_full.clear()
+            try:
+                await self.flush_writes()
+            except Exception:
+                log.exception("Ошибка группового коммита")
+
+    async def fetchone(self, sql: str, params=()):
+        start = time.perf_counter()
+        async with self.reader() as conn:
+            async with conn.execute(sql, params) as cursor:
+                row = await cursor.fetchone()
+        metrics.observe("db", sql_label(sql), time.perf_counter() - start)
+        return row
+
+    async def fetchall(self, sql: str, params=()):
+        start = time.perf_counter()
+        async with self.reader() as conn:
+            async with conn.execute(sql, params) as cursor:
+                rows = await cursor.fetchall()
+        metrics.observe("db", sql_label(sql), time.perf_counter() - start)
+        return rows
+
+    async def execute(self, sql: str, params=()):
+        # Сам запрос и коммит меряет transaction()
+        async with self.transaction() as conn:
+            async with conn.execute(sql, params) as cursor:
+                return cursor.rowcount
+
+database = Database(DB_NAME)
+
+# === МИГРАЦИИ ===
+# Версия схемы хранится в PRAGMA user_version. Новые изменения — только новой записью
+# в конце списка, старые не трогаем: по ним уже обновлены рабочие базы.
+MIGRATIONS = [
+    (1, [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            gender TEXT,
+            pref_gender TEXT,
+            age INTEGER,
+            pref_age_min INTEGER,
+            pref_age_max INTEGER,
+            is_vip INTEGER DEFAULT 0,
+            vip_until INTEGER DEFAULT 0,
+            boost_until INTEGER DEFAULT 0,
+            superlikes INTEGER DEFAULT 0
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS blocks (
+            blocker_id INTEGER,
+            blocked_id INTEGER,
+            PRIMARY KEY (blocker_id, blocked_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS chat_likes (
+            user1_id INTEGER,
+            user2_id INTEGER,
+            PRIMARY KEY (user1_id, user2_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS rebus_used (
+            user_id INTEGER PRIMARY KEY,
+            used INTEGER DEFAULT 0
+        )
+        """,
+    ]),
+    (2, [
+        """
+        CREATE TABLE IF NOT EXISTS likes (
+            liker_id INTEGER,
+            liked_id INTEGER,
+            created_at INTEGER,
+            PRIMARY KEY (liker_id, liked_id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_likes_liked ON likes (liked_id, created_at, liker_id)",
+        """
+        CREATE TABLE IF NOT EXISTS chat_sessions (
+            user_id INTEGER PRIMARY KEY,
+            partner_id INTEGER,
+            started_at INTEGER
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS fsm_state (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT,
+            updated_at INTEGER
+        )
+        """,
+    ]),
+    (3, [
+        # DELETE ... blocked_id = ? в /reset
+        "CREATE INDEX IF NOT EXISTS idx_blocks_blocked ON blocks (blocked_id, blocker_id)",
+        # обратное направление chat_likes в /reset
+        "CREATE INDEX IF NOT EXISTS idx_chat_likes_user2 ON chat_likes (user2_id, user1_id)",
+        # чистка брошенных регистраций
+        "CREATE INDEX IF NOT EXISTS idx_fsm_state_updated ON fsm_state (updated_at)",
+    ]),
+    (4, [
+        "ALTER TABLE users ADD COLUMN bot_blocked INTEGER DEFAULT 0",
+        """
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT,
+            status TEXT DEFAULT 'running',
+            cursor_id INTEGER DEFAULT 0,
+            total INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            blocked INTEGER DEFAULT 0,
+            started_at INTEGER,
+            finished_at INTEGER
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS broadcast_sent (
+            broadcast_id INTEGER,
+            user_id INTEGER,
+            PRIMARY KEY (broadcast_id, user_id)
+        )
+        """,
+    ]),
+    (5, [
+        # аренда рассылки: при нескольких воркерах её ведёт тот, кто последним продлил claimed_at
+        "ALTER TABLE broadcasts ADD COLUMN claimed_at INTEGER DEFAULT 0",
+    ]),
+]
+
 async def init_db():
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                gender TEXT,
-                pref_gender TEXT,
-                age INTEGER,
-                pref_age_min INTEGER,
-                pref_age_max INTEGER,
-                is_vip INTEGER DEFAULT 0,
-                vip_until INTEGER DEFAULT 0,
-                boost_until INTEGER DEFAULT 0,
-                superlikes INTEGER DEFAULT 0
-            )
-        """)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS blocks (
-                blocker_id INTEGER,
-                blocked_id INTEGER,
-                PRIMARY KEY (blocker_id, blocked_id)
-            )
-        """)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS chat_likes (
-                user1_id INTEGER,
-                user2_id INTEGER,
-                PRIMARY KEY (user1_id, user2_id)
-            )
-        """)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS rebus_used (
-                user_id INTEGER PRIMARY KEY,
-                used INTEGER DEFAULT 0
-            )
-        """)
-        await db.commit()
+    async with database.transaction() as db:
+        async with db.execute("PRAGMA user_version") as cursor:
+            version = (await cursor.fetchone())[0]
+        for target, statements in MIGRATIONS:
+            if target <= version:
+                continue
+            # Каждая миграция — своя транзакция вместе с новым номером версии
+            for sql in statements:
+                await db.execute(sql)
+            await db.execute(f"PRAGMA user_version = {target}")
+            await db.commit()
+            await db.execute("BEGIN IMMEDIATE")
+            log.info("Схема базы обновлена до версии %s", target)
+
+# === КЭШ АНКЕТ ===
+PROFILE_CACHE_SIZE = 50000
+PROFILE_CACHE_TTL = 300  # секунд; страховка, основное — явная инвалидация при записи
+
+class ProfileCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()  # user_id -> (expires_at, row)
+        self.epoch = 0  # растёт при каждой инвалидации, чтобы не положить устаревшее чтение
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: int):
+        entry = self.entries.get(user_id)
+        if entry and entry[0] > time.monotonic():
+            self.entries.move_to_end(user_id)
+            self.hits += 1
+            return True, entry[1]
+        self.misses += 1
+        return False, None
+
+    def put(self, user_id: int, row, epoch: int):
+        if epoch != self.epoch:
+            return
+        self.entries[user_id] = (time.monotonic() + self.ttl, row)
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        self.epoch += 1
+        self.entries.pop(user_id, None)
+
+profile_cache = ProfileCache(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL)
 
 async def get_user(user_id: int):
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)) as cursor:
-            return await cursor.fetchone()
+    found, user = profile_cache.get(user_id)
+    if found:
+        return user
+    epoch = profile_cache.epoch
+    user = await database.fetchone("SELECT * FROM users WHERE user_id = ?", (user_id,))
+    profile_cache.put(user_id, user, epoch)
+    return user
 
 async def add_user(user_id: int, gender: str, pref_gender: str, age: int, pref_min: int, pref_max: int):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("""
-            INSERT OR REPLACE INTO users
-            (user_id, gender, pref_gender, age, pref_age_min, pref_age_max, is_vip, vip_until, boost_until, superlikes)
-            VALUES (?, ?, ?, ?, ?, ?, 0, 0, 0, 0)
-        """, (user_id, gender, pref_gender, age, pref_min, pref_max))
-        await db.commit()
+    await database.execute("""
+        INSERT OR REPLACE INTO users
+        (user_id, gender, pref_gender, age, pref_age_min, pref_age_max, is_vip, vip_until, boost_until, superlikes)
+        VALUES (?, ?, ?, ?, ?, ?, 0, 0, 0, 0)
+    """, (user_id, gender, pref_gender, age, pref_min, pref_max))
+    profile_cache.invalidate(user_id)
+    expiry.cancel(user_id)
+    match_index.add(user_id, gender, pref_gender, age, pref_min, pref_max)
+    match_queues.forget(user_id)
 
 async def is_vip_active(user_id: int) -> bool:
     user = await get_user(user_id)
     if not user:
         return False
-    is_vip, vip_until = user[6], user[7]
-    return is_vip and (vip_until == 0 or vip_until > int(time.time()))
+    # is_vip снимает планировщик истечений, сроки здесь не сравниваем
+    return bool(user[6])
 
-async def find_match(user_id: int):
-    user = await get_user(user_id)
-    if not user:
+# === ИНДЕКС ПОИСКА ===
+MATCH_SAMPLE_LIMIT = 64  # сколько случайных проб до перехода на ограниченный проход
+MATCH_SCAN_LIMIT = 2048  # сколько анкет смотрит запасной проход, если пробы не нашли кандидата
+BLOCK_FRESH_MIN = 64     # свежие блоки копятся в set и сливаются в массив, когда их больше
+                         # max(BLOCK_FRESH_MIN, 1/8 массива) — слияние в среднем O(1) на блок
+
+class MatchIndex:
+    # Все анкеты в памяти: корзины (пол, кого ищет) отсортированы по возрасту,
+    # поэтому диапазон возрастов — это срез по bisect, а не проход по таблице.
+    def __init__(self):
+        self.profiles = {}  # user_id -> (gender, pref_gender, age, pref_min, pref_max, boosted)
+        self.buckets = {}   # (gender, pref_gender) -> [(age, user_id), ...]
+        self.boosted = {}   # те же корзины, но только анкеты с активным бустом
+        # Блоки — самая быстрорастущая таблица, поэтому не set (~110 байт на блок), а отсортированный
+        # array('q') (8 байт) с поиском по bisect; только у тех, кто кого-то блокировал
+        self.blocks = {}        # blocker_id -> array('q', [blocked_id, ...])
+        self.fresh_blocks = {}  # blocker_id -> {blocked_id, ...}, ещё не слитые в массив
+
+    def fill(self, users, blocks):
+        # users — строки SELECT * FROM users; корзины сортируем один раз, а не insort на каждую анкету
+        self.profiles.clear()
+        self.buckets.clear()
+        self.boosted.clear()
+        self.blocks.clear()
+        self.fresh_blocks.clear()
+        now = int(time.time())
+        for row in users:
+            self.profiles[row[0]] = (*row[1:6], row[8] > now)
+            self.buckets.setdefault((row[1], row[2]), []).append((row[3], row[0]))
+            if row[8] > now:
+                self.boosted.setdefault((row[1], row[2]), []).append((row[3], row[0]))
+        for bucket in (*self.buckets.values(), *self.boosted.values()):
+            bucket.sort()
+        # blocks отсортированы по первичному ключу (blocker_id, blocked_id) — массивы готовы сразу
+        for blocker_id, rows in groupby(blocks, key=lambda row: row[0]):
+            self.blocks[blocker_id] = array("q", [row[1] for row in rows])
+
+    def add(self, user_id, gender, pref_gender, age, pref_min, pref_max, boosted=False):
+        self._unlink(user_id)
+        self.profiles[user_id] = (gender, pref_gender, age, pref_min, pref_max, boosted)
+        insort(self.buckets.setdefault((gender, pref_gender), []), (age, user_id))
+        if boosted:
+            insort(self.boosted.setdefault((gender, pref_gender), []), (age, user_id))
+
+    def remove(self, user_id):
+        self._unlink(user_id)
+        self.blocks.pop(user_id, None)
+        self.fresh_blocks.pop(user_id, None)
+        for packed in self.blocks.values():
+            i = bisect_left(packed, user_id)
+            if i < len(packed) and packed[i] == user_id:
+                del packed[i]
+        for fresh in self.fresh_blocks.values():
+            fresh.discard(user_id)
+
+    def _unlink(self, user_id):
+        old = self.profiles.pop(user_id, None)
+        if old:
+            self._discard(self.buckets[(old[0], old[1])], (old[2], user_id))
+            if old[5]:
+                self._discard(self.boosted[(old[0], old[1])], (old[2], user_id))
+
+    @staticmethod
+    def _discard(bucket, entry):
+        i = bisect_left(bucket, entry)
+        if i < len(bucket) and bucket[i] == entry:
+            del bucket[i]
+
+    def set_boost(self, user_id, boosted: bool):
+        old = self.profiles.get(user_id)
+        if old and old[5] != boosted:
+            self.profiles[user_id] = old[:5] + (boosted,)
+            entry = (old[2], user_id)
+            if boosted:
+                insort(self.boosted.setdefault((old[0], old[1]), []), entry)
+            else:
+                self._discard(self.boosted[(old[0], old[1])], entry)
+
+    def block(self, blocker_id, blocked_id):
+        if self._has_block(blocker_id, blocked_id):
+            return
+        fresh = self.fresh_blocks.setdefault(blocker_id, set())
+        fresh.add(blocked_id)
+        packed = self.blocks.get(blocker_id, ())
+        if len(fresh) > max(BLOCK_FRESH_MIN, len(packed) // 8):
+            self.blocks[blocker_id] = array("q", sorted((*packed, *fresh)))
+            del self.fresh_blocks[blocker_id]
+
+    def _has_block(self, blocker_id, blocked_id):
+        packed = self.blocks.get(blocker_id)
+        if packed is not None:
+            i = bisect_left(packed, blocked_id)
+            if i < len(packed) and packed[i] == blocked_id:
+                return True
+        fresh = self.fresh_blocks.get(blocker_id)
+        return fresh is not None and blocked_id in fresh
+
+    def is_blocked(self, a, b):
+        return self._has_block(a, b) or self._has_block(b, a)
+
+    def _ranges(self, user_id, buckets=None):
+        my_gender, pref_gender, _, pref_min, pref_max, _ = self.profiles[user_id]
+        genders = ("m", "f") if pref_gender == "all" else (pref_gender,)
+        buckets = self.buckets if buckets is None else buckets
+        ranges = []
+        for gender in genders:
+            for cand_pref in (my_gender, "all"):
+                bucket = buckets.get((gender, cand_pref))
+                if not bucket:
+                    continue
+                lo = bisect_left(bucket, (pref_min,))
+                hi = bisect_right(bucket, (pref_max, float("inf")))
+                if lo < hi:
+                    ranges.append((bucket, lo, hi))
+        return ranges
+
+    @staticmethod
+    def _nth(ranges, k):
+        # k-я анкета, если склеить срезы подряд
+        for bucket, lo, hi in ranges:
+            if k < hi - lo:
+                return bucket[lo + k][1]
+            k -= hi - lo
+
+    def _eligible(self, user_id, cand_id):
+        return cand_id != user_id and not self.is_blocked(user_id, cand_id)
+
+    def is_compatible(self, user_id, cand_id):
+        me, cand = self.profiles.get(user_id), self.profiles.get(cand_id)
+        if not me or not cand or not self._eligible(user_id, cand_id):
+            return False
+        return ((me[1] == "all" or me[1] == cand[0]) and (cand[1] == "all" or cand[1] == me[0])
+                and me[3] <= cand[2] <= me[4])
+
+    def pick(self, user_id):
+        if user_id not in self.profiles:
+            return None
+        ranges = self._ranges(user_id)
+        total = sum(hi - lo for _, lo, hi in ranges)
+        if not total:
+            return None
+        boosted = self._ranges(user_id, self.boosted)
+        boosted_total = sum(hi - lo for _, lo, hi in boosted)
+
+        # Два пула: бусты берём из своих срезов, обычную — равномерно из всего среза,
+        # отбрасывая попавшие бусты. Поэтому у обычного пула вес total, а не число
+        # обычных анкет: после отбрасывания остаётся ровно их доля. Отказ — только на
+        # бустах внутри среза, а не 1 - 1/BOOST_WEIGHT на каждой пробе.
+        boosted_mass = boosted_total * BOOST_WEIGHT
+        mass = boosted_mass + total
+        cand_id = None
+        for _ in range(MATCH_SAMPLE_LIMIT):
+            if random.random() * mass < boosted_mass:
+                uid = self._nth(boosted, random.randrange(boosted_total))
+            else:
+                uid = self._nth(ranges, random.randrange(total))
+                if self.profiles[uid][5]:
+                    continue
+            if self._eligible(user_id, uid):
+                cand_id = uid
+                break
+
+        # Почти все пробы мимо (много блоков) — взвешенный reservoir (A-Res) по окну
+        # из MATCH_SCAN_LIMIT анкет со случайного места, чтобы не ходить по всему срезу
+        if cand_id is None:
+            best = 0.0
+            start = random.randrange(total)
+            for j in range(min(total, MATCH_SCAN_LIMIT)):
+                uid = self._nth(ranges, (start + j) % total)
+                if self._eligible(user_id, uid):
+                    key = random.random() ** (1.0 / self._weight(uid))
+                    if key >= best:
+                        best, cand_id = key, uid
+            if cand_id is None:
+                return None
+
+        gender, _, age, _, _, _ = self.profiles[cand_id]
+        return cand_id, gender, age
+
+    def _weight(self, uid):
+        return BOOST_WEIGHT if self.profiles[uid][5] else 1
+
+match_index = MatchIndex()
+
+# === ОЧЕРЕДИ АНКЕТ ===
+MATCH_QUEUE_SIZE = 5      # сколько анкет держим наготове
+MATCH_QUEUE_LOW = 2       # ниже этого — фоновое пополнение
+MATCH_QUEUE_USERS = 10000 # очереди только для последних активных
+MATCH_REFILL_DELAY = 0.05 # окно, за которое копится пачка заявок
+
+class MatchQueues:
+    # /search только снимает анкету из очереди; пополняет их одна фоновая задача пачками.
+    # Кандидат перепроверяется при выдаче, так что блок/сброс/смена анкеты не протекут.
+    def __init__(self, index: MatchIndex):
+        self.index = index
+        self.queues = OrderedDict()  # user_id -> deque(cand_id)
+        self._pending = set()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def pop(self, user_id: int):
+        queue = self.queues.get(user_id)
+        match = None
+        if queue is not None:
+            self.queues.move_to_end(user_id)
+            while queue:
+                cand_id = queue.popleft()
+                if self.index.is_compatible(user_id, cand_id):
+                    gender, _, age, _, _, _ = self.index.profiles[cand_id]
+                    match = (cand_id, gender, age)
+                    break
+        if match is None:
+            match = self.index.pick(user_id)
+        if queue is None or len(queue) < MATCH_QUEUE_LOW:
+            self.request(user_id)
+        return match
+
+    def request(self, user_id: int):
+        self._pending.add(user_id)
+        self._wakeup.set()
+
+    def drop(self, user_id: int, cand_id: int):
+        queue = self.queues.get(user_id)
+        if queue and cand_id in queue:
+            queue.remove(cand_id)
+
+    def forget(self, user_id: int):
+        # Свою очередь выбрасываем целиком, в чужих пользователь отсеется при выдаче
+        self.queues.pop(user_id, None)
+        self._pending.discard(user_id)
+
+    def _refill(self, user_id: int):
+        queue = self.queues.get(user_id)
+        if queue is None:
+            queue = self.queues[user_id] = deque()
+            while len(self.queues) > MATCH_QUEUE_USERS:
+                self.queues.popitem(last=False)
+        for _ in range(MATCH_QUEUE_SIZE * 2):
+            if len(queue) >= MATCH_QUEUE_SIZE:
+                break
+            match = self.index.pick(user_id)
+            if match is None:
+                break
+            if match[0] not in queue:
+                queue.append(match[0])
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            await asyncio.sleep(MATCH_REFILL_DELAY)
+            self._wakeup.clear()
+            batch, self._pending = self._pending, set()
+            for i, user_id in enumerate(batch):
+                if user_id in self.index.profiles:
+                    self._refill(user_id)
+                if i % 100 == 99:
+                    await asyncio.sleep(0)
+
+match_queues = MatchQueues(match_index)
+
+# === АКТИВНЫЕ ЧАТЫ ===
+def chat_shard(user_id: int) -> int:
+    # Мультипликативный хэш, чтобы соседние id расходились по разным процессам.
+    # Вебхук отдаёт апдейты пользователя только его процессу, поэтому пересылка сообщений
+    # читает партнёра из кэша владельца, а не из chat_sessions.
+    return (user_id * 2654435761) % 2 ** 32 % CHAT_WORKERS
+
+class MemoryChatStore:
+    def __init__(self):
+        self.partners = {}  # user_id -> partner_id
+
+    def owns(self, user_id: int) -> bool:
+        return chat_shard(user_id) == CHAT_WORKER_ID
+
+    async def get_partner(self, user_id: int):
+        return self.partners.get(user_id)
+
+    async def connect(self, a: int, b: int):
+        for user_id in (a, b):
+            self._unlink(user_id)
+        self.partners[a] = b
+        self.partners[b] = a
+
+    async def disconnect(self, user_id: int):
+        return self._unlink(user_id)
+
+    def _unlink(self, user_id: int):
+        partner = self.partners.pop(user_id, None)
+        if partner is not None and self.partners.get(partner) == user_id:
+            del self.partners[partner]
+        return partner
+
+class SqliteChatStore(MemoryChatStore):
+    # Источник правды — таблица chat_sessions, self.partners — кэш перед ней.
+    # В одном процессе кэш полный и всегда верен; при CHAT_WORKERS > 1 процесс держит
+    # только своих пользователей (chat_shard) и перечитывает их раз в CHAT_CACHE_TTL.
+    def __init__(self, db: Database):
+        super().__init__()
+        self.db = db
+        self.cached_at = {}
+
+    def fill(self, rows):
+        self.partners.clear()
+        self.cached_at.clear()
+        now = time.monotonic()
+        for user_id, partner_id in rows:
+            if self.owns(user_id):
+                self.partners[user_id] = partner_id
+                self.cached_at[user_id] = now
+
+    def _cache(self, user_id: int, partner):
+        if CHAT_WORKERS > 1 and not self.owns(user_id):
+            return
+        if partner is None:
+            self.partners.pop(user_id, None)
+        else:
+            self.partners[user_id] = partner
+        self.cached_at[user_id] = time.monotonic()
+
+    async def get_partner(self, user_id: int):
+        if CHAT_WORKERS == 1:
+            return self.partners.get(user_id)
+        if self.owns(user_id) and time.monotonic() - self.cached_at.get(user_id, float("-inf")) < CHAT_CACHE_TTL:
+            return self.partners.get(user_id)
+        row = await self.db.fetchone("SELECT partner_id FROM chat_sessions WHERE user_id = ?", (user_id,))
+        partner = row[0] if row else None
+        self._cache(user_id, partner)
+        return partner
+
+    async def _unlink_row(self, db, user_id: int):
+        async with db.execute("SELECT partner_id FROM chat_sessions WHERE user_id = ?", (user_id,)) as cursor:
+            row = await cursor.fetchone()
+        if not row:
+            return None
+        await db.execute("DELETE FROM chat_sessions WHERE user_id = ?", (user_id,))
+        await db.execute("DELETE FROM chat_sessions WHERE user_id = ? AND partner_id = ?", (row[0], user_id))
+        return row[0]
+
+    async def connect(self, a: int, b: int):
+        async with self.db.transaction() as db:
+            old = [await self._unlink_row(db, user_id) for user_id in (a, b)]
+            now = int(time.time())
+            await db.execute("INSERT INTO chat_sessions (user_id, partner_id, started_at) VALUES (?, ?, ?), (?, ?, ?)",
+                             (a, b, now, b, a, now))
+        for partner in old:
+            if partner is not None:
+                self._cache(partner, None)
+        self._cache(a, b)
+        self._cache(b, a)
+
+    async def disconnect(self, user_id: int):
+        async with self.db.transaction() as db:
+            partner = await self._unlink_row(db, user_id)
+        self._cache(user_id, None)
+        if partner is not None:
+            self._cache(partner, None)
+        return partner
+
+chat_store = SqliteChatStore(database) if CHAT_STORE == "sqlite" else MemoryChatStore()
+
+# === ИСТЕЧЕНИЕ VIP И БУСТОВ ===
+class ExpiryScheduler:
+    # Куча ближайших сроков vip_until / boost_until. Когда срок наступил, флаги снимаются
+    # пачкой, а горячие пути (пересылка, поиск) читают только готовые is_vip / boosted.
+    # clock подменяется в проверках, чтобы не ждать реального времени.
+    def __init__(self, db: Database, clock=time.time):
+        self.db = db
+        self.clock = clock
+        self.heap = []      # (deadline, kind, user_id), kind — "vip" или "boost"
+        self.deadlines = {} # (kind, user_id) -> актуальный срок; записи кучи с другим сроком устарели
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self.expired = 0
+
+    def fill(self, users):
+        # users — строки SELECT * FROM users; просроченное снимет следующий run_due
+        rows = [(row[7], "vip", row[0]) for row in users if row[6] == 1 and row[7] > 0]
+        rows += [(row[8], "boost", row[0]) for row in users if row[8] > 0]
+        heapq.heapify(rows)
+        self.heap = rows
+        self.deadlines = {(kind, uid): until for until, kind, uid in rows}
+
+    def schedule(self, user_id: int, kind: str, deadline: int):
+        self.deadlines[(kind, user_id)] = deadline
+        heapq.heappush(self.heap, (deadline, kind, user_id))
+        self._wakeup.set()
+
+    def cancel(self, user_id: int, kind: str = None):
+        # Вечный VIP или удалённая анкета: запись в куче останется, но уже ничего не снимет
+        for k in ((kind,) if kind else ("vip", "boost")):
+            self.deadlines.pop((k, user_id), None)
+
+    async def run_due(self):
+        now = self.clock()
+        vip, boost = [], []
+        while self.heap and self.heap[0][0] <= now:
+            deadline, kind, user_id = heapq.heappop(self.heap)
+            if self.deadlines.get((kind, user_id)) != deadline:
+                continue
+            (vip if kind == "vip" else boost).append((user_id, deadline))
+        if not vip and not boost:
+            return
+        # Условие на сам срок — страховка, если запись в базе поменяли в обход планировщика
+        try:
+            async with self.db.transaction() as db:
+                await db.executemany("UPDATE users SET is_vip = 0 WHERE user_id = ? AND vip_until = ?", vip)
+                await db.executemany("UPDATE users SET boost_until = 0 WHERE user_id = ? AND boost_until = ?", boost)
+        except BaseException:
+            # Не сохранилось (например, SQLITE_BUSY от соседнего процесса) — возвращаем записи
+            # в кучу, следующий run_due повторит. deadlines не трогали, так что продление
+            # или отмена за это время по-прежнему делают запись устаревшей.
+            for kind, due in (("vip", vip), ("boost", boost)):
+                for user_id, deadline in due:
+                    heapq.heappush(self.heap, (deadline, kind, user_id))
+            raise
+        for kind, due in (("vip", vip), ("boost", boost)):
+            for user_id, deadline in due:
+                # Продлили, пока шёл коммит, — UPDATE по старому сроку ничего не снял
+                if self.deadlines.get((kind, user_id)) != deadline:
+                    continue
+                del self.deadlines[(kind, user_id)]
+                if kind == "boost":
+                    match_index.set_boost(user_id, False)
+                profile_cache.invalidate(user_id)
+                self.expired += 1
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self):
+        while True:
+            timeout = max(0, self.heap[0][0] - self.clock()) if self.heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.run_due()
+            except Exception:
+                log.exception("Не удалось снять истёкшие VIP/бусты")
+                await asyncio.sleep(1)  # сроки вернулись в кучу и уже наступили — не крутимся вхолостую
+
+expiry = ExpiryScheduler(database)
+
+# === ОТПРАВКА СООБЩЕНИЙ ===
+SEND_RATE = 30            # сообщений в секунду на всего бота (лимит Telegram)
+SEND_CHAT_RATE = 1        # сообщений в секунду в один чат
+SEND_CHAT_BURST = 3
+SEND_WORKERS = 8
+SEND_MAX_RETRIES = 5
+SEND_RETRY_LIMIT = 1000   # сколько сообщений одновременно может ждать повтора
+SEND_CHAT_BUCKETS = 10000 # лимитеры чатов, дольше всех молчавшие, выкидываются
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def delay(self) -> float:
+        # 0 — токен взят, иначе сколько ждать до следующего
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self):
+        while wait := self.delay():
+            await asyncio.sleep(wait)
+
+class Outbox:
+    # Хендлеры только кладут сообщение в очередь чата. Воркеры берут чаты по одному,
+    # поэтому порядок внутри чата сохраняется, а ожидание лимита чата не занимает воркер.
+    def __init__(self, workers: int = SEND_WORKERS):
+        self.workers_count = workers
+        self.chats = {}  # chat_id -> deque([method, args, kwargs, attempts]); есть ключ — чат в работе
+        self.buckets = OrderedDict()
+        self.global_bucket = TokenBucket(SEND_RATE, SEND_RATE)
+        self.ready = asyncio.Queue()
+        self.retrying = 0
+        self.sent = 0
+        self.failed = 0
+        self._workers = []
+
+    def start(self):
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.workers_count)]
+
+    async def stop(self, timeout: float = 5):
+        deadline = time.monotonic() + timeout
+        while self.chats and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+
+    def send(self, chat_id: int, method, *args, **kwargs):
+        queue = self.chats.get(chat_id)
+        if queue is None:
+            queue = self.chats[chat_id] = deque()
+            self.ready.put_nowait(chat_id)
+        queue.append([method, args, kwargs, 0])
+
+    def pending(self) -> int:
+        return sum(len(queue) for queue in self.chats.values())
+
+    def _later(self, delay: float, chat_id: int):
+        asyncio.get_running_loop().call_later(delay, self.ready.put_nowait, chat_id)
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.buckets[chat_id] = TokenBucket(SEND_CHAT_RATE, SEND_CHAT_BURST)
+            if len(self.buckets) > SEND_CHAT_BUCKETS:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(chat_id)
+        return bucket
+
+    async def _worker(self):
+        while True:
+            chat_id = await self.ready.get()
+            wait = self._bucket(chat_id).delay()
+            if wait:
+                self._later(wait, chat_id)
+                continue
+            await self.global_bucket.acquire()
+            if self._deliver(chat_id, await self._attempt(chat_id)):
+                queue = self.chats[chat_id]
+                if queue:
+                    self.ready.put_nowait(chat_id)
+                else:
+                    del self.chats[chat_id]
+
+    async def _attempt(self, chat_id: int):
+        method, args, kwargs, _ = self.chats[chat_id][0]
+        try:
+            await method(chat_id, *args, **kwargs)
+        except Exception as e:
+            if isinstance(e, TelegramRetryAfter):
+                metrics.inc("send_retry_after", method.__name__)
+            return e
         return None
-    _, my_gender, pref_gender, _, pref_min, pref_max, _, _, boost_until, _ = user
-    now = int(time.time())
 
-    async with aiosqlite.connect(DB_NAME) as db:
-        rows = await db.execute_fetchall("""
-            SELECT u.user_id, u.gender, u.age FROM users u
-            LEFT JOIN blocks b1 ON b1.blocker_id = ? AND b1.blocked_id = u.user_id
-            LEFT JOIN blocks b2 ON b2.blocker_id = u.user_id AND b2.blocked_id = ?
-            WHERE u.user_id != ?
-            AND u.age BETWEEN ? AND ?
-            AND b1.blocked_id IS NULL
-            AND b2.blocked_id IS NULL
-            ORDER BY u.boost_until > ? DESC, RANDOM()
-        """, (user_id, user_id, user_id, pref_min, pref_max, now))
-
-        candidates = []
-        for row in rows:
-            cand_id, cand_gender, cand_age = row
-            cand_pref = (await get_user(cand_id))[2]
-            if (cand_pref == "all" or cand_pref == my_gender) and (pref_gender == "all" or pref_gender == cand_gender):
-                candidates.append((cand_id, cand_gender, cand_age))
-
-        if candidates:
-            return choice(candidates)
-    return None
+    def _deliver(self, chat_id: int, error) -> bool:
+        # True — голова очереди чата обработана (отправлена или выброшена)
+        job = self.chats[chat_id][0]
+        if error is None:
+            self.sent += 1
+        elif isinstance(error, TelegramRetryAfter):
+            # 429 — флуд-контроль на весь бот: пока не выйдет retry_after, молчат все воркеры
+            self.global_bucket.pause(error.retry_after)
+            self._later(error.retry_after, chat_id)
+            return False
+        elif isinstance(error, (TelegramNetworkError, TelegramServerError)) and job[3] < SEND_MAX_RETRIES \
+                and (job[3] or self.retrying < SEND_RETRY_LIMIT):
+            if not job[3]:
+                self.retrying += 1
+            job[3] += 1
+            self._later(2 ** job[3] * 0.5, chat_id)
+            return False
+        else:
+            self.failed += 1
+            metrics.inc("send_failed", f"{job[0].__name__}:{type(error).__name__}")
+            log.warning("Не доставлено в %s: %r", chat_id, error)
+        if job[3]:
+            self.retrying -= 1
+        self.chats[chat_id].popleft()
+        return True
+
+outbox = Outbox()
+
+# === АЛЬБОМЫ ===
+ALBUM_WAIT = 0.5          # секунд от первой части альбома до отправки
+ALBUM_MAX_ITEMS = 10      # больше Telegram в один альбом не принимает
+ALBUM_MAX_PENDING = 1000  # незавершённых альбомов в памяти; лишние уходят сразу
+
+class AlbumBuffer:
+    # Части альбома приходят отдельными апдейтами с общим media_group_id. Собираем их
+    # и пересылаем одним send_media_group; по таймауту уходит и неполный альбом.
+    def __init__(self):
+        self.groups = OrderedDict()  # (sender_id, media_group_id) -> [partner, prefix, [message, ...], timer]
+
+    def add(self, message: types.Message, partner: int, prefix: str):
+        key = (message.from_user.id, message.media_group_id)
+        group = self.groups.get(key)
+        if group is None:
+            timer = asyncio.get_running_loop().call_later(ALBUM_WAIT, self.flush, key)
+            group = self.groups[key] = [partner, prefix, [], timer]
+            while len(self.groups) > ALBUM_MAX_PENDING:
+                self.flush(next(iter(self.groups)))
+        group[2].append(message)
+        if len(group[2]) >= ALBUM_MAX_ITEMS:
+            self.flush(key)
+
+    def flush_sender(self, sender_id: int):
+        # Перед обычным сообщением досылаем альбомы отправителя, чтобы не нарушить порядок
+        for key in [key for key in self.groups if key[0] == sender_id]:
+            self.flush(key)
+
+    def flush(self, key):
+        group = self.groups.pop(key, None)
+        if group is None:
+            return
+        partner, prefix, messages, timer = group
+        timer.cancel()
+        messages.sort(key=lambda m: m.message_id)
+        media = []
+        for i, m in enumerate(messages):
+            caption = (prefix if i == 0 else "") + (m.caption or "")
+            if m.photo:
+                media.append(InputMediaPhoto(media=m.photo[-1].file_id, caption=caption or None))
+            elif m.video:
+                media.append(InputMediaVideo(media=m.video.file_id, caption=caption or None))
+            elif m.document:
+                media.append(InputMediaDocument(media=m.document.file_id, caption=caption or None))
+            elif m.audio:
+                media.append(InputMediaAudio(media=m.audio.file_id, caption=caption or None))
+        if len(media) > 1:
+            outbox.send(partner, bot.send_media_group, media)
+            return
+        # Альбом из одной части send_media_group не примет
+        for m in messages:
+            relay_single(m, partner, prefix)
+
+album_buffer = AlbumBuffer()
+
+# === РАССЫЛКА ===
+BROADCAST_CHUNK = 500       # получателей читаем из базы порциями по user_id
+BROADCAST_CONCURRENCY = 16
+BROADCAST_RATE = 20         # в секунду; остаток общего SEND_RATE — обычным сообщениям
+BROADCAST_REPORT_EVERY = 5  # секунд между обновлениями статуса у админа
+BROADCAST_LEASE = 120       # секунд без продления claimed_at — воркер считается упавшим
+
+class Broadcaster:
+    # Прогресс хранится в broadcasts (курсор по user_id + счётчики) и broadcast_sent
+    # (кто уже обработан) — прерванная рассылка продолжается без повторов.
+    def __init__(self, db: Database):
+        self.db = db
+        self.bucket = TokenBucket(BROADCAST_RATE, BROADCAST_RATE)
+        self.task = None
+        self._watcher = None
+        self._stopping = False
+        self.blocked = set()  # у кого bot_blocked = 1 — чтобы не писать в базу на каждый апдейт
+
+    async def unblock(self, user_id: int):
+        # Пишет боту — значит, снова его не блокирует
+        if user_id in self.blocked:
+            self.blocked.discard(user_id)
+            await self.db.write_behind("UPDATE users SET bot_blocked = 0 WHERE user_id = ?", (user_id,))
+
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    async def start(self, text: str) -> int:
+        total = (await self.db.fetchone("SELECT COUNT(*) FROM users WHERE bot_blocked = 0"))[0]
+        async with self.db.transaction() as db:
+            cursor = await db.execute("INSERT INTO broadcasts (text, total, started_at, claimed_at) VALUES (?, ?, ?, ?)",
+                                      (text, total, int(time.time()), int(time.time())))
+            broadcast_id = cursor.lastrowid
+        self.task = asyncio.create_task(self._run(broadcast_id))
+        return broadcast_id
+
+    async def resume(self):
+        # Захват и проверка в одной транзакции (BEGIN IMMEDIATE): из нескольких воркеров
+        # рассылку подхватит только один, остальные увидят свежий claimed_at
+        if self.running():
+            return
+        now = int(time.time())
+        async with self.db.transaction() as db:
+            async with db.execute("SELECT id FROM broadcasts WHERE status = 'running' AND claimed_at < ? ORDER BY id LIMIT 1",
+                                  (now - BROADCAST_LEASE,)) as cursor:
+                row = await cursor.fetchone()
+            if row:
+                await db.execute("UPDATE broadcasts SET claimed_at = ? WHERE id = ?", (now, row[0]))
+        if row:
+            self._stopping = False
+            self.task = asyncio.create_task(self._run(row[0]))
+
+    def watch(self):
+        # Рассылку упавшего воркера подхватывает другой, когда истечёт аренда
+        self._watcher = asyncio.create_task(self._watch())
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(BROADCAST_LEASE / 4)
+            try:
+                await self.resume()
+            except Exception:
+                log.exception("Не удалось проверить прерванные рассылки")
+
+    async def stop(self, timeout: float = 5):
+        # Новые отправки не начинаем, начатые дожидаемся — иначе при продолжении они уйдут повторно
+        if self._watcher:
+            self._watcher.cancel()
+            self._watcher = None
+        if not self.running():
+            return
+        self._stopping = True
+        try:
+            await asyncio.wait_for(asyncio.shield(self.task), timeout)
+        except asyncio.TimeoutError:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def _send(self, broadcast_id: int, user_id: int, text: str, semaphore: asyncio.Semaphore):
+        async with semaphore:
+            while True:
+                if self._stopping:
+                    return None
+                await self.bucket.acquire()
+                await outbox.global_bucket.acquire()
+                try:
+                    await bot.send_message(user_id, text)
+                    result = "sent"
+                except TelegramRetryAfter as e:
+                    # 429 — лимит всего бота: останавливаем оба ведра, а не только эту корутину
+                    self.bucket.pause(e.retry_after)
+                    outbox.global_bucket.pause(e.retry_after)
+                    continue
+                except TelegramForbiddenError:
+                    self.blocked.add(user_id)
+                    await self.db.write_behind("UPDATE users SET bot_blocked = 1 WHERE user_id = ?", (user_id,))
+                    result = "blocked"
+                except TelegramAPIError:
+                    result = "failed"
+                break
+            await self.db.write_behind("INSERT OR IGNORE INTO broadcast_sent (broadcast_id, user_id) VALUES (?, ?)",
+                                       (broadcast_id, user_id))
+            return result
+
+    async def _report(self, broadcast_id, status_message, total, counts, rate, done=False):
+        processed = sum(counts.values())
+        eta = (total - processed) / rate if rate else 0
+        text = (
+            f"📣 Рассылка #{broadcast_id}{' завершена' if done else ''}\n"
+            f"Отправлено: {counts['sent']} из {total}\n"
+            f"Ошибок: {counts['failed']}, заблокировали бота: {counts['blocked']}\n"
+        )
+        if not done:
+            text += f"Скорость: {rate:.1f}/с, осталось ~{int(eta // 60)} мин {int(eta % 60)} с"
+        try:
+            if status_message:
+                await bot.edit_message_text(text, chat_id=ADMIN_ID, message_id=status_message.message_id)
+                return status_message
+            return await bot.send_message(ADMIN_ID, text)
+        except TelegramAPIError:
+            return status_message
+
+    async def _run(self, broadcast_id: int):
+        text, cursor_id, total, sent, failed, blocked = await self.db.fetchone(
+            "SELECT text, cursor_id, total, sent, failed, blocked FROM broadcasts WHERE id = ?", (broadcast_id,))
+        counts = {"sent": sent, "failed": failed, "blocked": blocked}
+        semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+        started, started_processed = time.monotonic(), sum(counts.values())
+        status_message = await self._report(broadcast_id, None, total, counts, 0)
+        last_report = time.monotonic()
+        while True:
+            rows = await self.db.fetchall(
+                "SELECT user_id FROM users WHERE user_id > ? AND bot_blocked = 0 ORDER BY user_id LIMIT ?",
+                (cursor_id, BROADCAST_CHUNK))
+            if not rows:
+                break
+            ids = [user_id for (user_id,) in rows]
+            done = {user_id for (user_id,) in await self.db.fetchall(
+                "SELECT user_id FROM broadcast_sent WHERE broadcast_id = ? AND user_id BETWEEN ? AND ?",
+                (broadcast_id, ids[0], ids[-1]))}
+            results = await asyncio.gather(*(self._send(broadcast_id, user_id, text, semaphore)
+                                             for user_id in ids if user_id not in done))
+            for result in results:
+                if result:
+                    counts[result] += 1
+            if not self._stopping:
+                cursor_id = ids[-1]
+            # Транзакция сначала сохраняет накопленные отметки broadcast_sent, потом курсор.
+            # Заодно продлеваем аренду; при остановке отпускаем её — после рестарта продолжим сразу
+            await self.db.execute(
+                "UPDATE broadcasts SET cursor_id = ?, sent = ?, failed = ?, blocked = ?, claimed_at = ? WHERE id = ?",
+                (cursor_id, counts["sent"], counts["failed"], counts["blocked"],
+                 0 if self._stopping else int(time.time()), broadcast_id))
+            if self._stopping:
+                return
+            if time.monotonic() - last_report >= BROADCAST_REPORT_EVERY:
+                rate = (sum(counts.values()) - started_processed) / (time.monotonic() - started)
+                status_message = await self._report(broadcast_id, status_message, total, counts, rate)
+                last_report = time.monotonic()
+        await self.db.execute("UPDATE broadcasts SET status = 'done', finished_at = ? WHERE id = ?",
+                              (int(time.time()), broadcast_id))
+        await self._report(broadcast_id, status_message, total, counts, 0, done=True)
+
+broadcaster = Broadcaster(database)
+
+class BotUnblockedMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is not None and broadcaster.blocked:
+            await broadcaster.unblock(user.id)
+        return await handler(event, data)
+
+# === СОСТОЯНИЯ РЕГИСТРАЦИИ ===
+FSM_FLUSH_INTERVAL = 1.0  # секунд между пакетными сбросами на диск
+FSM_TTL = 24 * 3600       # брошенная регистрация удаляется через сутки
+FSM_HOT_IDLE = 600        # чистые записи без обращений дольше этого выгружаются из памяти
+
+class SqliteStorage(BaseStorage):
+    # Горячий слой в памяти отвечает на все чтения, изменения копятся в dirty
+    # и раз в FSM_FLUSH_INTERVAL пишутся на диск одной транзакцией.
+    # При CHAT_WORKERS > 1 горячий слой держит только своих пользователей (chat_shard):
+    # вебхук приводит их апдейты только сюда. Чужой ключ (апдейт пришёл в обход маршрутизации
+    # или шарды поменялись после рестарта) читается с диска и пишется сразу, мимо кэша.
+    def __init__(self, db: Database):
+        self.db = db
+        self.hot = {}  # key -> [state, data, updated_at, used_at]
+        self.dirty = set()
+        self._task = None
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.business_connection_id or ''}:{key.destiny}"
+
+    async def _entry(self, key: StorageKey):
+        k = self._key(key)
+        entry = self.hot.get(k) if chat_store.owns(key.user_id) else None
+        if entry is None:
+            row = await self.db.fetchone("SELECT state, data, updated_at FROM fsm_state WHERE key = ?", (k,))
+            entry = [row[0], json.loads(row[1]), row[2], 0] if row else [None, {}, 0, 0]
+            if chat_store.owns(key.user_id):
+                entry = self.hot.setdefault(k, entry)
+        entry[3] = time.monotonic()
+        return k, entry
+
+    async def _touch(self, key: StorageKey, k: str, entry):
+        entry[2] = int(time.time())
+        if chat_store.owns(key.user_id):
+            self.dirty.add(k)
+        else:
+            await self._save({k: entry})
+
+    async def set_state(self, key: StorageKey, state=None):
+        k, entry = await self._entry(key)
+        entry[0] = state.state if isinstance(state, State) else state
+        await self._touch(key, k, entry)
+
+    async def get_state(self, key: StorageKey):
+        _, entry = await self._entry(key)
+        return entry[0]
+
+    async def set_data(self, key: StorageKey, data):
+        k, entry = await self._entry(key)
+        entry[1] = data.copy()
+        await self._touch(key, k, entry)
+
+    async def get_data(self, key: StorageKey):
+        _, entry = await self._entry(key)
+        return entry[1].copy()
+
+    async def flush(self):
+        if not self.dirty:
+            return
+        keys, self.dirty = self.dirty, set()
+        try:
+            await self._save({k: self.hot[k] for k in keys})
+        except Exception:
+            self.dirty |= keys
+            raise
+
+    async def _save(self, entries):
+        upserts, deletes = [], []
+        for k, (state, data, updated_at, _) in entries.items():
+            if state is None and not data:
+                deletes.append((k,))
+            else:
+                upserts.append((k, state, json.dumps(data, ensure_ascii=False), updated_at))
+        # Одна транзакция: после падения на диске либо весь пакет, либо ничего
+        async with self.db.transaction() as db:
+            await db.executemany("DELETE FROM fsm_state WHERE key = ?", deletes)
+            await db.executemany("INSERT OR REPLACE INTO fsm_state (key, state, data, updated_at) VALUES (?, ?, ?, ?)", upserts)
+
+    async def expire(self):
+        cutoff = int(time.time()) - FSM_TTL
+        idle = time.monotonic() - FSM_HOT_IDLE
+        for k, (state, data, updated_at, used_at) in list(self.hot.items()):
+            if (state is not None or data) and updated_at < cutoff:
+                self.hot[k] = [None, {}, int(time.time()), used_at]
+                self.dirty.discard(k)
+            elif used_at < idle and k not in self.dirty:
+                del self.hot[k]
+        await self.db.execute("DELETE FROM fsm_state WHERE updated_at < ?", (cutoff,))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        last_expire = time.monotonic()
+        while True:
+            await asyncio.sleep(FSM_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+                if time.monotonic() - last_expire > 60:
+                    last_expire = time.monotonic()
+                    await self.expire()
+            except Exception:
+                log.exception("Не удалось сохранить состояния FSM")
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+storage = SqliteStorage(database)
+dp = Dispatcher(storage=storage)
+for observer in (dp.message, dp.callback_query, dp.pre_checkout_query):
+    observer.middleware(HandlerMetricsMiddleware())
+dp.update.outer_middleware(BotUnblockedMiddleware())
+metrics.gauges.update({
+    "profile_cache_size": lambda: len(profile_cache.entries),
+    "profile_cache_hits": lambda: profile_cache.hits,
+    "profile_cache_misses": lambda: profile_cache.misses,
+    "match_queues": lambda: len(match_queues.queues),
+    "outbox_pending": outbox.pending,
+    "outbox_retrying": lambda: outbox.retrying,
+    "outbox_sent": lambda: outbox.sent,
+    "outbox_failed": lambda: outbox.failed,
+    "db_write_behind_pending": lambda: len(database._batch),
+    "fsm_hot": lambda: len(storage.hot),
+    "expiry_heap": lambda: len(expiry.heap),
+    "webhook_pending_updates": lambda: update_lanes.pending,
+    "album_pending": lambda: len(album_buffer.groups),
+    "startup_ready_seconds": lambda: startup_stats.get("ready", 0),
+    "startup_budget_seconds": lambda: STARTUP_BUDGET,
+})
 
 # === КОМАНДЫ ===
 @dp.message(Command("start"))
@@ -129,9 +1555,9 @@ async def start(message: types.Message, state: FSMContext):
     user = await get_user(message.from_user.id)
     
     if message.from_user.id == ADMIN_ID:
-        async with aiosqlite.connect(DB_NAME) as db:
-            await db.execute("UPDATE users SET is_vip = 1, vip_until = 0 WHERE user_id = ?", (ADMIN_ID,))
-            await db.commit()
+        await database.execute("UPDATE users SET is_vip = 1, vip_until = 0 WHERE user_id = ?", (ADMIN_ID,))
+        profile_cache.invalidate(ADMIN_ID)
+        expiry.cancel(ADMIN_ID, "vip")
     
     help_text = (
         "👋 Добро пожаловать в анонимные знакомства!\n\n"
@@ -140,6 +1566,7 @@ async def start(message: types.Message, state: FSMContext):
         "/stop — завершить чат\n"
         "/reset — удалить профиль\n"
         "/like — взаимные симпатии\n"
+        "/fans — кто тебя лайкнул\n"
         "/premium — премиум-фичи (тест)\n"
         "/help — руководство\n\n"
         "Удачных знакомств ❤️"
@@ -163,6 +1590,7 @@ async def help_command(message: types.Message):
         "/stop — завершить чат (потом отзыв)\n"
         "/reset — начать заново\n"
         "/like — взаимные симпатии после чата\n"
+        "/fans — кто тебя лайкнул\n"
         "/premium — купить VIP/буст/суперлайк (тест)\n"
         "/help — это меню\n\n"
         "После взаимного лайка — сразу чат 💕",
@@ -221,7 +1649,10 @@ async def process_max_age(message: types.Message, state: FSMContext):
 
 @dp.message(Command("search"))
 async def search(message: types.Message):
-    match = await find_match(message.from_user.id)
+    await show_next_match(message, message.from_user.id)
+
+async def show_next_match(message: types.Message, user_id: int):
+    match = match_queues.pop(user_id)
     if not match:
         await message.answer("Пока никого нет по твоим критериям 😔\nПопробуй позже или измени настройки (/reset)")
         return
@@ -239,51 +1670,51 @@ async def search(message: types.Message):
 async def dislike(callback: types.CallbackQuery):
     target_id = int(callback.data.split("_")[1])
     my_id = callback.from_user.id
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("INSERT OR IGNORE INTO blocks (blocker_id, blocked_id) VALUES (?, ?)", (my_id, target_id))
-        await db.commit()
+    match_index.block(my_id, target_id)
+    await database.write_behind("INSERT OR IGNORE INTO blocks (blocker_id, blocked_id) VALUES (?, ?)", (my_id, target_id))
+    match_queues.drop(my_id, target_id)
     await callback.message.edit_text("👎 Дислайк. Ищем следующую анкету...")
-    await search(callback.message)
+    await show_next_match(callback.message, my_id)
 
 @dp.callback_query(F.data.startswith("like_"))
 async def like(callback: types.CallbackQuery):
     target_id = int(callback.data.split("_")[1])
     my_id = callback.from_user.id
-    target_match = await find_match(target_id)
-    if target_match and target_match[0] == my_id:
-        active_chats[my_id] = target_id
-        active_chats[target_id] = my_id
+    # Взаимность — один поиск по первичному ключу в той же транзакции, что и вставка
+    async with database.transaction() as db:
+        await db.execute("INSERT OR IGNORE INTO likes (liker_id, liked_id, created_at) VALUES (?, ?, ?)", (my_id, target_id, int(time.time())))
+        async with db.execute("SELECT 1 FROM likes WHERE liker_id = ? AND liked_id = ?", (target_id, my_id)) as cursor:
+            mutual = await cursor.fetchone()
+    if mutual:
+        await chat_store.connect(my_id, target_id)
         await callback.message.edit_text("💕 Взаимный лайк! Чат открыт — пиши сообщение!")
-        await bot.send_message(target_id, "💕 Взаимный лайк! Чат открыт — пиши сообщение!")
+        outbox.send(target_id, bot.send_message, "💕 Взаимный лайк! Чат открыт — пиши сообщение!")
     else:
         await callback.message.edit_text("❤️ Лайк отправлен. Ждём ответа...")
-        await search(callback.message)
+        await show_next_match(callback.message, my_id)
 
 @dp.message(Command("stop"))
 async def stop_chat(message: types.Message):
-    partner = active_chats.get(message.from_user.id)
+    # Недособранный альбом уходит прежнему собеседнику до уведомления о конце чата
+    album_buffer.flush_sender(message.from_user.id)
+    partner = await chat_store.disconnect(message.from_user.id)
     if not partner:
         await message.answer("Ты не в чате.")
         return
-    my_id = message.from_user.id
-    del active_chats[my_id]
-    del active_chats[partner]
     await message.answer("Чат завершён.\n\nКак тебе собеседник?",
                          reply_markup=InlineKeyboardMarkup(inline_keyboard=[
                              [InlineKeyboardButton(text="❤️ Понравился", callback_data=f"feedback_like_{partner}")],
                              [InlineKeyboardButton(text="👎 Не очень", callback_data=f"feedback_dislike_{partner}")]
                          ]))
-    await bot.send_message(partner, "Собеседник завершил чат.")
+    outbox.send(partner, bot.send_message, "Собеседник завершил чат.")
 
 @dp.callback_query(F.data.startswith("feedback_like_"))
 async def feedback_like(callback: types.CallbackQuery):
     target_id = int(callback.data.split("_")[2])
     my_id = callback.from_user.id
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("INSERT OR IGNORE INTO chat_likes (user1_id, user2_id) VALUES (?, ?)", (my_id, target_id))
-        await db.commit()
-        async with db.execute("SELECT 1 FROM chat_likes WHERE user1_id = ? AND user2_id = ?", (target_id, my_id)) as cursor:
-            mutual = await cursor.fetchone()
+    # Ждём общего коммита пачки: иначе встречный лайк может ещё не быть на диске
+    await database.write_behind("INSERT OR IGNORE INTO chat_likes (user1_id, user2_id) VALUES (?, ?)", (my_id, target_id), wait=True)
+    mutual = await database.fetchone("SELECT 1 FROM chat_likes WHERE user1_id = ? AND user2_id = ?", (target_id, my_id))
     if mutual:
         await callback.message.edit_text("❤️ Вы оба понравились друг другу! Найди в /like")
     else:
@@ -293,22 +1724,22 @@ async def feedback_like(callback: types.CallbackQuery):
 async def feedback_dislike(callback: types.CallbackQuery):
     target_id = int(callback.data.split("_")[2])
     my_id = callback.from_user.id
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("INSERT OR IGNORE INTO blocks (blocker_id, blocked_id) VALUES (?, ?), (?, ?)", (my_id, target_id, target_id, my_id))
-        await db.commit()
+    match_index.block(my_id, target_id)
+    match_index.block(target_id, my_id)
+    await database.write_behind("INSERT OR IGNORE INTO blocks (blocker_id, blocked_id) VALUES (?, ?), (?, ?)", (my_id, target_id, target_id, my_id))
+    match_queues.drop(my_id, target_id)
+    match_queues.drop(target_id, my_id)
     await callback.message.edit_text("👎 Этот человек больше не появится в поиске.")
 
 @dp.message(Command("like"))
 async def show_matches(message: types.Message):
     my_id = message.from_user.id
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("""
-            SELECT u.user_id, u.gender, u.age FROM chat_likes cl
-            JOIN users u ON u.user_id = cl.user2_id
-            WHERE cl.user1_id = ?
-            AND EXISTS (SELECT 1 FROM chat_likes WHERE user1_id = cl.user2_id AND user2_id = cl.user1_id)
-        """, (my_id,)) as cursor:
-            matches = await cursor.fetchall()
+    matches = await database.fetchall("""
+        SELECT u.user_id, u.gender, u.age FROM chat_likes cl
+        JOIN users u ON u.user_id = cl.user2_id
+        WHERE cl.user1_id = ?
+        AND EXISTS (SELECT 1 FROM chat_likes WHERE user1_id = cl.user2_id AND user2_id = cl.user1_id)
+    """, (my_id,))
     if not matches:
         await message.answer("Пока нет взаимных симпатий после чата 😔")
         return
@@ -320,26 +1751,74 @@ async def show_matches(message: types.Message):
         keyboard.append([InlineKeyboardButton(text="Написать снова", callback_data=f"rematch_{m_id}")])
     await message.answer(text + "\nНажми кнопку, чтобы возобновить чат!", reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard), parse_mode="HTML")
 
+FANS_PAGE_SIZE = 10
+
+async def fans_page(user_id: int, cursor=None):
+    # Курсор — (created_at, liker_id) последней показанной записи: страница = диапазон по индексу
+    if cursor is None:
+        cursor = (2 ** 62, 0)
+    rows = await database.fetchall("""
+        SELECT l.liker_id, l.created_at, u.gender, u.age FROM likes l
+        JOIN users u ON u.user_id = l.liker_id
+        WHERE l.liked_id = ? AND (l.created_at, l.liker_id) < (?, ?)
+        ORDER BY l.created_at DESC, l.liker_id DESC
+        LIMIT ?
+    """, (user_id, cursor[0], cursor[1], FANS_PAGE_SIZE + 1))
+    has_more = len(rows) > FANS_PAGE_SIZE
+    rows = rows[:FANS_PAGE_SIZE]
+    if not rows:
+        return None, None
+    text = "😍 <b>Тебя лайкнули:</b>\n\n"
+    keyboard = []
+    for liker_id, created_at, gender, age in rows:
+        g_text = "Парень" if gender == "m" else "Девушка"
+        text += f"• {g_text}, {age} лет\n"
+        keyboard.append([InlineKeyboardButton(text=f"❤️ {g_text}, {age}", callback_data=f"like_{liker_id}")])
+    if has_more:
+        last_id, last_at = rows[-1][0], rows[-1][1]
+        keyboard.append([InlineKeyboardButton(text="Дальше ➡️", callback_data=f"fans_{last_at}_{last_id}")])
+    return text + "\nЛайкни в ответ — и сразу откроется чат!", InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+@dp.message(Command("fans"))
+async def show_fans(message: types.Message):
+    text, keyboard = await fans_page(message.from_user.id)
+    if not text:
+        await message.answer("Пока никто не лайкнул твою анкету 😔")
+        return
+    await message.answer(text, reply_markup=keyboard, parse_mode="HTML")
+
+@dp.callback_query(F.data.startswith("fans_"))
+async def show_fans_more(callback: types.CallbackQuery):
+    _, created_at, liker_id = callback.data.split("_")
+    text, keyboard = await fans_page(callback.from_user.id, (int(created_at), int(liker_id)))
+    if not text:
+        await callback.answer("Больше никого нет")
+        return
+    await callback.message.edit_text(text, reply_markup=keyboard, parse_mode="HTML")
+
 @dp.callback_query(F.data.startswith("rematch_"))
 async def rematch(callback: types.CallbackQuery):
     target_id = int(callback.data.split("_")[1])
     my_id = callback.from_user.id
-    active_chats[my_id] = target_id
-    active_chats[target_id] = my_id
+    await chat_store.connect(my_id, target_id)
     await callback.message.edit_text("💬 Чат возобновлён!")
-    await bot.send_message(target_id, "💬 Твой прошлый собеседник хочет продолжить! Чат возобновлён.")
+    outbox.send(target_id, bot.send_message, "💬 Твой прошлый собеседник хочет продолжить! Чат возобновлён.")
 
 @dp.message(Command("reset"))
 async def reset_profile(message: types.Message):
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with database.transaction() as db:
         await db.execute("DELETE FROM users WHERE user_id = ?", (message.from_user.id,))
         await db.execute("DELETE FROM blocks WHERE blocker_id = ? OR blocked_id = ?", (message.from_user.id, message.from_user.id))
         await db.execute("DELETE FROM chat_likes WHERE user1_id = ? OR user2_id = ?", (message.from_user.id, message.from_user.id))
-        await db.commit()
-    if message.from_user.id in active_chats:
-        partner = active_chats.pop(message.from_user.id)
-        active_chats.pop(partner, None)
-        await bot.send_message(partner, "Собеседник удалил профиль.")
+        await db.execute("DELETE FROM likes WHERE liker_id = ? OR liked_id = ?", (message.from_user.id, message.from_user.id))
+    profile_cache.invalidate(message.from_user.id)
+    expiry.cancel(message.from_user.id)
+    match_index.remove(message.from_user.id)
+    match_queues.forget(message.from_user.id)
+    album_buffer.flush_sender(message.from_user.id)
+    partner = await chat_store.disconnect(message.from_user.id)
+    if partner:
+        outbox.send(partner, bot.send_message, "Собеседник удалил профиль.")
     await message.answer("Профиль удалён. /start — начать заново")
 
 @dp.message(Command("debug"))
@@ -347,10 +1826,37 @@ async def debug(message: types.Message):
     if message.from_user.id != ADMIN_ID:
         await message.answer("Только для админа.")
         return
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("SELECT COUNT(*) FROM users") as cursor:
-            total = (await cursor.fetchone())[0]
-    await message.answer(f"Анкет в базе: {total}")
+    total = (await database.fetchone("SELECT COUNT(*) FROM users"))[0]
+    ms = lambda seconds: f"{seconds * 1000:.1f}"
+    text = (
+        f"Анкет в базе: {total}\n"
+        f"Кэш анкет: {len(profile_cache.entries)} шт., попаданий {profile_cache.hits}, промахов {profile_cache.misses}\n"
+        f"Очереди анкет: {len(match_queues.queues)}, отправка: в очереди {outbox.pending()}, "
+        f"ждут повтора {outbox.retrying}, доставлено {outbox.sent}, ошибок {outbox.failed}\n"
+        f"Отложенные записи: {len(database._batch)}, истечений в очереди: {len(expiry.heap)}\n"
+        f"Запуск: {', '.join(f'{stage} {ms(seconds)}' for stage, seconds in startup_stats.items())} мс\n"
+    )
+    for title, family in (("Хендлеры", "handler"), ("База", "db"), ("Bot API", "api")):
+        text += f"\n{title} (шт. / p50 / p95 / p99, мс):\n"
+        for name, count, p50, p95, p99 in metrics.summary(family, top=5):
+            text += f"• {name[:40]}: {count} / {ms(p50)} / {ms(p95)} / {ms(p99)}\n"
+    errors = sum(n for (family, _), n in metrics.counters.items() if family in ("handler_errors", "send_failed"))
+    await message.answer(text + f"\nОшибок хендлеров и отправки: {errors}")
+
+@dp.message(Command("broadcast"))
+async def broadcast(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("Только для админа.")
+        return
+    parts = message.text.split(maxsplit=1)
+    if len(parts) < 2:
+        await message.answer("Напиши текст рассылки: /broadcast текст")
+        return
+    if broadcaster.running():
+        await message.answer("Рассылка уже идёт — дождись её окончания.")
+        return
+    broadcast_id = await broadcaster.start(parts[1])
+    await message.answer(f"📣 Рассылка #{broadcast_id} запущена. Прогресс пришлю отдельным сообщением.")
 
 @dp.message(Command("premium"))
 async def premium_menu(message: types.Message):
@@ -383,50 +1889,49 @@ async def send_test_invoice(callback: types.CallbackQuery):
     now = int(time.time())
 
     if data == "buy_vip":
-        async with aiosqlite.connect(DB_NAME) as db:
-            await db.execute("UPDATE users SET is_vip = 1, vip_until = 0 WHERE user_id = ?", (user_id,))
-            await db.commit()
+        await database.execute("UPDATE users SET is_vip = 1, vip_until = 0 WHERE user_id = ?", (user_id,))
+        profile_cache.invalidate(user_id)
+        expiry.cancel(user_id, "vip")
         await callback.message.edit_text("🎉 VIP навсегда активирован (тест)! Всё работает ❤️")
     elif data == "buy_boost":
         boost_until = now + 86400
-        async with aiosqlite.connect(DB_NAME) as db:
-            await db.execute("UPDATE users SET boost_until = ? WHERE user_id = ?", (boost_until, user_id))
-            await db.commit()
+        await database.execute("UPDATE users SET boost_until = ? WHERE user_id = ?", (boost_until, user_id))
+        profile_cache.invalidate(user_id)
+        match_index.set_boost(user_id, True)
+        expiry.schedule(user_id, "boost", boost_until)
         await callback.message.edit_text("🚀 Буст активирован на 24 часа (тест)!")
     elif data == "buy_superlike":
-        async with aiosqlite.connect(DB_NAME) as db:
-            await db.execute("UPDATE users SET superlikes = superlikes + 1 WHERE user_id = ?", (user_id,))
-            await db.commit()
+        await database.execute("UPDATE users SET superlikes = superlikes + 1 WHERE user_id = ?", (user_id,))
+        profile_cache.invalidate(user_id)
         await callback.message.edit_text("💌 Суперлайк куплен (тест)!")
 
 @dp.message(Command("9889"))
 async def activate_rebus_vip(message: types.Message):
     user_id = message.from_user.id
     
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("SELECT used FROM rebus_used WHERE user_id = ?", (user_id,)) as cursor:
-            row = await cursor.fetchone()
-            if row and row[0] == 1:
-                await message.answer("❌ Ты уже активировал VIP по ребусу! Один раз на аккаунт — навсегда.")
-                return
-        
-        async with db.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,)) as cursor:
-            if not await cursor.fetchone():
-                await message.answer("Сначала зарегистрируйся: /start")
-                return
-        
-        now = int(time.time())
-        vip_until = now + 14 * 86400
-        
+    row = await database.fetchone("SELECT used FROM rebus_used WHERE user_id = ?", (user_id,))
+    if row and row[0] == 1:
+        await message.answer("❌ Ты уже активировал VIP по ребусу! Один раз на аккаунт — навсегда.")
+        return
+
+    if not await database.fetchone("SELECT 1 FROM users WHERE user_id = ?", (user_id,)):
+        await message.answer("Сначала зарегистрируйся: /start")
+        return
+
+    now = int(time.time())
+    vip_until = now + 14 * 86400
+
+    async with database.transaction() as db:
         await db.execute("UPDATE users SET is_vip = 1, vip_until = ? WHERE user_id = ?", (vip_until, user_id))
         await db.execute("INSERT OR REPLACE INTO rebus_used (user_id, used) VALUES (?, 1)", (user_id,))
-        await db.commit()
-    
+    profile_cache.invalidate(user_id)
+    expiry.schedule(user_id, "vip", vip_until)
+
     await message.answer("🎉 VIP по ребусу активирован на 14 дней!\nСпасибо, что решил ребус 🧠")
 
 @dp.message()
 async def forward_message(message: types.Message):
-    partner = active_chats.get(message.from_user.id)
+    partner = await chat_store.get_partner(message.from_user.id)
     if not partner:
         return
 
@@ -439,25 +1944,219 @@ async def forward_message(message: types.Message):
         username = message.from_user.username or message.from_user.full_name
         sender_prefix = f"От: @{username}\n\n" if message.from_user.username else f"От: {message.from_user.full_name}\n\n"
 
+    if message.media_group_id:
+        album_buffer.add(message, partner, sender_prefix)
+        return
+    if album_buffer.groups:
+        album_buffer.flush_sender(message.from_user.id)
+    relay_single(message, partner, sender_prefix)
+
+def relay_single(message: types.Message, partner: int, sender_prefix: str):
+    if message.text:
+        outbox.send(partner, bot.send_message, sender_prefix + message.text)
+    elif message.photo:
+        outbox.send(partner, bot.send_photo, message.photo[-1].file_id, caption=sender_prefix + (message.caption or ""))
+    elif message.video:
+        outbox.send(partner, bot.send_video, message.video.file_id, caption=sender_prefix + (message.caption or ""))
+    elif message.voice:
+        outbox.send(partner, bot.send_voice, message.voice.file_id, caption=sender_prefix)
+    elif message.sticker:
+        outbox.send(partner, bot.send_sticker, message.sticker.file_id)
+    else:
+        outbox.send(partner, bot.copy_message, message.from_user.id, message.message_id)
+
+# === ВЕБХУК ===
+class UpdateLanes:
+    # Апдейты одного пользователя идут строго по очереди, разных — параллельно,
+    # но не больше WEBHOOK_CONCURRENCY одновременно.
+    def __init__(self, limit: int):
+        self.semaphore = asyncio.Semaphore(limit)
+        self.lanes = {}  # key -> deque(update); есть ключ — пользователь в обработке
+        self.pending = 0
+        self.tasks = set()
+
+    def submit(self, key, update: types.Update):
+        self.pending += 1
+        lane = self.lanes.get(key)
+        if lane is not None:
+            lane.append(update)
+            return
+        self.lanes[key] = deque([update])
+        task = asyncio.create_task(self._run(key))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _run(self, key):
+        lane = self.lanes[key]
+        while lane:
+            async with self.semaphore:
+                try:
+                    await dp.feed_update(bot, lane[0])
+                except Exception:
+                    log.exception("Ошибка обработки апдейта %s", lane[0].update_id)
+            lane.popleft()
+            self.pending -= 1
+        del self.lanes[key]
+
+    async def drain(self, timeout: float):
+        if self.tasks:
+            await asyncio.wait(set(self.tasks), timeout=timeout)
+
+update_lanes = UpdateLanes(WEBHOOK_CONCURRENCY)
+webhook_draining = False
+webhook_peers = None  # aiohttp.ClientSession для пересылки апдейтов соседним процессам
+WEBHOOK_FORWARD_TIMEOUT = 5
+
+async def forward_update(owner: int, body: bytes) -> int:
+    # Ответ владельца возвращаем Telegram как есть: 503 или обрыв — и он повторит апдейт
+    headers = {"Content-Type": "application/json", "X-Bot-Forwarded": str(CHAT_WORKER_ID)}
+    if WEBHOOK_SECRET:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = WEBHOOK_SECRET
     try:
-        if message.text:
-            await bot.send_message(partner, sender_prefix + message.text)
-        elif message.photo:
-            await bot.send_photo(partner, message.photo[-1].file_id, caption=sender_prefix + (message.caption or ""))
-        elif message.video:
-            await bot.send_video(partner, message.video.file_id, caption=sender_prefix + (message.caption or ""))
-        elif message.voice:
-            await bot.send_voice(partner, message.voice.file_id, caption=sender_prefix)
-        elif message.sticker:
-            await bot.send_sticker(partner, message.sticker.file_id)
-        else:
-            await bot.copy_message(partner, message.from_user.id, message.message_id)
-    except:
-        pass
+        async with webhook_peers.post(f"http://127.0.0.1:{WEBHOOK_PORT + owner}{WEBHOOK_PATH}", data=body,
+                                      headers=headers) as response:
+            metrics.inc("webhook_forwarded", str(owner))
+            return response.status
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        metrics.inc("webhook_forward_errors", f"{owner}:{type(e).__name__}")
+        return 503
 
-async def main():
+async def webhook_handler(request):
+    from aiohttp import web
+    if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return web.Response(status=401)
+    if webhook_draining or update_lanes.pending >= WEBHOOK_MAX_PENDING:
+        return web.Response(status=503)
+    body = await request.read()
+    try:
+        update = types.Update.model_validate(json.loads(body), context={"bot": bot})
+    except ValueError:  # битый JSON и ValidationError pydantic — оба ValueError
+        log.warning("Отброшен некорректный апдейт от %s", request.remote)
+        return web.Response(status=400)
+    user = getattr(update.event, "from_user", None)
+    # Уже пересланный апдейт обрабатываем здесь, даже если шарды настроены по-разному, — без петель
+    if user and not chat_store.owns(user.id) and "X-Bot-Forwarded" not in request.headers:
+        return web.Response(status=await forward_update(chat_shard(user.id), body))
+    update_lanes.submit(user.id if user else ("update", update.update_id), update)
+    return web.Response()
+
+async def health_handler(request):
+    from aiohttp import web
+    return web.json_response({
+        "status": "draining" if webhook_draining else "ok",
+        "pending_updates": update_lanes.pending,
+        "active_users": len(update_lanes.lanes),
+    })
+
+async def run_webhook():
+    global webhook_draining, webhook_peers
+    from aiohttp import web
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, webhook_handler)
+    app.router.add_get("/health", health_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT + CHAT_WORKER_ID).start()
+    if CHAT_WORKERS > 1:
+        webhook_peers = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=WEBHOOK_FORWARD_TIMEOUT))
+    if WEBHOOK_URL and CHAT_WORKER_ID == 0:
+        await bot.set_webhook(WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                              allowed_updates=dp.resolve_used_update_types())
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+    # Новые апдейты — 503 (Telegram повторит их на другой реплике), начатые — дорабатываем
+    webhook_draining = True
+    await update_lanes.drain(timeout=10)
+    await runner.cleanup()
+    if webhook_peers:
+        await webhook_peers.close()
+
+# === ЗАПУСК ===
+STARTUP_WARM_PROFILES = int(os.getenv("STARTUP_WARM_PROFILES", "10000"))  # анкет в кэш сразу при старте
+STARTUP_BUDGET = float(os.getenv("STARTUP_BUDGET", "3"))  # секунд от импорта до готовности; дольше — предупреждение
+
+startup_stats = {}  # этап -> секунды; "ready" — от начала импорта до готовности отвечать
+IMPORTED_AT = time.perf_counter()
+
+async def warm_up():
+    # Один проход по users кормит индекс поиска, кучу истечений и кэш анкет;
+    # blocks и chat_sessions читаются параллельно на других соединениях пула
+    queries = [database.fetchall("SELECT * FROM users"),
+               database.fetchall("SELECT blocker_id, blocked_id FROM blocks ORDER BY blocker_id, blocked_id")]
+    if isinstance(chat_store, SqliteChatStore):
+        queries.append(database.fetchall("SELECT user_id, partner_id FROM chat_sessions"))
+    users, blocks, *sessions = await asyncio.gather(*queries)
+    match_index.fill(users, blocks)
+    expiry.fill(users)
+    broadcaster.blocked = {row[0] for row in users if row[10]}
+    if sessions:
+        chat_store.fill(sessions[0])
+    # Первыми греем собеседников из активных чатов — им сразу пересылать сообщения
+    in_chat = {uid for row in sessions[0] for uid in row} if sessions else set()
+    warm = [row for row in users if row[0] in in_chat][:STARTUP_WARM_PROFILES]
+    warm += [row for row in users if row[0] not in in_chat][:STARTUP_WARM_PROFILES - len(warm)]
+    epoch = profile_cache.epoch
+    for row in warm:
+        profile_cache.put(row[0], row, epoch)
+    await expiry.run_due()
+
+async def startup():
+    startup_stats["import"] = IMPORTED_AT - STARTED_AT
+    t = time.perf_counter()
+    await database.open()
     await init_db()
-    await dp.start_polling(bot)
+    startup_stats["db"] = time.perf_counter() - t
+    t = time.perf_counter()
+    await warm_up()
+    startup_stats["warm_up"] = time.perf_counter() - t
+    expiry.start()
+    storage.start()
+    match_queues.start()
+    outbox.start()
+    bot.session.middleware(ApiMetricsMiddleware())
+    startup_stats["ready"] = time.perf_counter() - STARTED_AT
+    stages = ", ".join(f"{stage} {seconds:.3f}" for stage, seconds in startup_stats.items())
+    if startup_stats["ready"] > STARTUP_BUDGET:
+        log.warning("Запуск дольше бюджета %.1f с: %s", STARTUP_BUDGET, stages)
+    else:
+        log.info("Готов за %.3f с: %s", startup_stats["ready"], stages)
+    # Необязательное — после отметки готовности, в её бюджет не входит
+    await broadcaster.resume()
+    broadcaster.watch()
+
+async def shutdown():
+    await broadcaster.stop()
+    for key in list(album_buffer.groups):
+        album_buffer.flush(key)
+    await outbox.stop()
+    await match_queues.stop()
+    await expiry.stop()
+    await storage.close()
+    await database.close()
+    await bot.session.close()
+
+async def main():
+    if CHAT_WORKERS > 1 and SERVE_MODE != "webhook":
+        raise RuntimeError("CHAT_WORKERS > 1 работает только с SERVE_MODE=webhook: "
+                           "getUpdates нельзя поделить между процессами")
+    metrics_runner = None
+    try:
+        await startup()
+        metrics_runner = await start_metrics_server() if METRICS_PORT else None
+        if SERVE_MODE == "webhook":
+            await run_webhook()
+        else:
+            # Сессию закрывает shutdown(), когда очередь отправки уже разобрана
+            await dp.start_polling(bot, close_bot_session=False)
+    finally:
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await shutdown()
 
 if __name__ == "__main__":
     asyncio.run(main())